@@ -11,4 +11,7 @@ sys.path.append(path.dirname(__file__))
 
 if __name__ == '__main__':
     args = get_args()
-    TestMgr(args.test, args.group, args.server).run()
+    TestMgr(args.test, args.group, args.server, args.distribute,
+            args.schedule, args.timeout, args.deploy_mode, args.watch,
+            args.changed_since, args.explain_selection, args.follow,
+            args.tail_lines, args.transport).run()
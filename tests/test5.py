@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 #group-C13 : enabled
+#requires : bin/divideby0
 
 from os import path
 import subprocess
@@ -2,16 +2,25 @@
 
 import argparse
 
+from .envmgr import DEPLOY_MODES, DEPLOY_RELAY, DEPLOY_SFTP
 from .exceptions import InvalidArgumentError
+from .schedmgr import DISTRIBUTE_ALL, DISTRIBUTE_MODES
+from .schedmgr import SCHEDULE_GLOB, SCHEDULE_MODES
+from .transport import TRANSPORT_LOCAL, TRANSPORT_MODES, TRANSPORT_SSH
 
 
 def validate_args(args):
-    if args.test is None and args.group is None:
-        raise InvalidArgumentError('No --test or --group was provided')
+    if args.test is None and args.group is None and args.changed_since is None:
+        msg = 'No --test, --group or --changed-since was provided'
+        raise InvalidArgumentError(msg)
 
     if args.test is not None and args.group is not None:
         raise InvalidArgumentError('--test and --group can\'t be used together')
 
+    if args.transport == TRANSPORT_LOCAL and args.deploy_mode == DEPLOY_RELAY:
+        msg = '--deploy-mode relay can\'t be used with --transport local'
+        raise InvalidArgumentError(msg)
+
 
 def get_args():
     """Construct and return supported arguments"""
@@ -21,10 +30,56 @@ def get_args():
 
     argparser.add_argument('-t', '--test', help='The test to be run, which is '\
                            'mutually exclusive from --group', action='append')
-    argparser.add_argument('-g', '--group', help='The test group to be run',
+    argparser.add_argument('-g', '--group', help='The test group to be run, '\
+                           'or an expression of groups with "and", "or", '\
+                           '"not" and parentheses, e.g. "C13 and not AAA"',
                            action='append')
     argparser.add_argument('-s', '--server', help='The test machine to run the '\
                            'tests', action='append', required=True)
+    argparser.add_argument('-d', '--distribute', help='How tests are '\
+                           'distributed to test machines: "all" runs every '\
+                           'test on every machine, "shard" runs each test on '\
+                           'one machine only, "queue" runs each test once on '\
+                           'whichever machine pulls it first from a queue '\
+                           'shared by all machines', choices=DISTRIBUTE_MODES,
+                           default=DISTRIBUTE_ALL)
+    argparser.add_argument('--schedule', help='The order in which tests are '\
+                           'run: "glob" keeps the order tests are found, "lpt" '\
+                           'runs the longest tests first per test history, '\
+                           '"failed-first" runs tests failed last time first',
+                           choices=SCHEDULE_MODES, default=SCHEDULE_GLOB)
+    argparser.add_argument('--timeout', help='The default seconds a test may '\
+                           'run before being aborted, tests can override it '\
+                           'with "#timeout : <seconds>"', type=float)
+    argparser.add_argument('--deploy-mode', help='How files are copied to '\
+                           'test machines: "sftp" copies files one by one, '\
+                           '"archive" streams them as a single tar.gz, "relay" '\
+                           'streams a tar.gz to a few machines which forward '\
+                           'it to the others',
+                           choices=DEPLOY_MODES, default=DEPLOY_SFTP)
+    argparser.add_argument('--transport', help='How test machines are '\
+                           'reached: "ssh" deploys and runs tests over ssh, '\
+                           '"local" runs every given machine as an agent on '\
+                           'this host without ssh', choices=TRANSPORT_MODES,
+                           default=TRANSPORT_SSH)
+    argparser.add_argument('-w', '--watch', help='Keep running after tests '\
+                           'are done, and re-run tests whenever their scripts '\
+                           'or the files they use change, until Ctrl-C is '\
+                           'pressed', action='store_true')
+    argparser.add_argument('--changed-since', help='Only run tests whose '\
+                           'scripts or dependencies changed in local git '\
+                           'working tree since the given revision, combined '\
+                           'with --test or --group if given', metavar='REV')
+    argparser.add_argument('--follow', help='Show the latest output line of '\
+                           'the given test while it runs, its output is saved '\
+                           'under log/follow as well', metavar='TEST')
+    argparser.add_argument('--tail-lines', help='Keep the last N lines of '\
+                           'output of each test, which are printed out for '\
+                           'failed tests when testing is done', type=int,
+                           default=0, metavar='N')
+    argparser.add_argument('--explain-selection', help='Print out the tests '\
+                           'which would be run and why, without running them',
+                           action='store_true')
 
     args = argparser.parse_args()
     validate_args(args)
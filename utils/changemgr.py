@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+import logging
+from os import path
+import subprocess
+
+from .exceptions import InvalidArgumentError
+from .logger import get_logger
+
+
+logger = get_logger('ChangeMgr', level=logging.DEBUG)
+
+
+class ChangeMgr(object):
+    """The util class for finding files changed in local git working tree"""
+
+    @staticmethod
+    def git(work_dir, *args):
+        """Run git command in 'work_dir' and return its output"""
+
+        cmd = ['git', '-C', work_dir] + list(args)
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, check=True)
+        except FileNotFoundError:
+            raise InvalidArgumentError('git is not installed')
+        except subprocess.CalledProcessError as e:
+            error = e.stderr.decode('utf-8', 'replace').strip()
+            msg = '"{}" failed: {}'.format(' '.join(cmd), error)
+            raise InvalidArgumentError(msg)
+        return proc.stdout.decode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def changed_files(rev, work_dir):
+        """Return absolute paths of files modified in the git working tree of
+        'work_dir' since revision 'rev', including changes not committed yet
+        and untracked files.
+        """
+
+        top_dir = ChangeMgr.git(work_dir, 'rev-parse', '--show-toplevel')
+        top_dir = top_dir.strip()
+        diff = ChangeMgr.git(top_dir, 'diff', '--name-only', '-z', rev, '--')
+        untracked = ChangeMgr.git(top_dir, 'ls-files', '--others',
+                                  '--exclude-standard', '-z')
+
+        changed = set()
+        for relpath in (diff + untracked).split('\0'):
+            if relpath:
+                changed.add(path.normpath(path.join(top_dir, relpath)))
+        logger.info('%d files changed since %s', len(changed), rev)
+        return changed
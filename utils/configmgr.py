@@ -3,11 +3,17 @@
 import configparser
 import logging
 from os import path
+import tempfile
 
 from .exceptions import InvalidConfigError
+from .fanout import DEFAULT_CONCURRENCY, DEFAULT_RELAY_FANOUT
 from .logger import get_logger
+from .message import DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_HEARTBEAT_MISSES
 
 
+# Private key of daemon is kept out of the source tree
+host_key_file = path.join(path.expanduser('~'), '.easytest', 'daemon_host_key')
+local_testdir = path.join(tempfile.gettempdir(), 'easytest')
 logger = get_logger('ConfigMgr', level=logging.DEBUG)
 
 
@@ -26,10 +32,26 @@ class ConfigMgr:
         self.server_username = self.config.get('server', 'username')
         self.server_password = self.config.get('server', 'password')
         self.server_testdir = self.config.get('server', 'testdir')
+        self.server_concurrency = self.config.getint(
+            'server', 'concurrency', fallback=DEFAULT_CONCURRENCY)
+        self.server_relay_fanout = self.config.getint(
+            'server', 'relay_fanout', fallback=DEFAULT_RELAY_FANOUT)
 
         self.daemon_username = self.config.get('daemon', 'username')
         self.daemon_password = self.config.get('daemon', 'password')
         self.daemon_port = self.config.getint('daemon', 'port')
+        self.daemon_heartbeat_interval = self.config.getfloat(
+            'daemon', 'heartbeat_interval', fallback=DEFAULT_HEARTBEAT_INTERVAL)
+        self.daemon_heartbeat_misses = self.config.getint(
+            'daemon', 'heartbeat_misses', fallback=DEFAULT_HEARTBEAT_MISSES)
+        self.daemon_host_key = path.expanduser(self.config.get(
+            'daemon', 'host_key', fallback=host_key_file))
+        self.daemon_host_key_type = self.config.get('daemon', 'host_key_type',
+                                                    fallback='rsa')
+
+        # Directory where tests are deployed with local transport
+        self.local_testdir = self.config.get('local', 'testdir',
+                                             fallback=local_testdir)
 
     def _read_config(self, cf):
         """Parse configuration file and return config object"""
@@ -47,7 +69,14 @@ class ConfigMgr:
 
     def __str__(self):
         fmt = 'server_username:{}, server_password:{}, server_testdir: {}, '\
-              'daemon_usernmae:{}, daemon_password:{}, daemon_port:{}'
+              'server_concurrency:{}, server_relay_fanout:{}, '\
+              'daemon_usernmae:{}, daemon_password:{}, daemon_port:{}, '\
+              'daemon_heartbeat_interval:{}, daemon_heartbeat_misses:{}, '\
+              'daemon_host_key:{}, daemon_host_key_type:{}, local_testdir:{}'
         return fmt.format(self.server_username, self.server_password,
-                          self.server_testdir, self.daemon_username,
-                          self.daemon_password, self.daemon_port)
+                          self.server_testdir, self.server_concurrency,
+                          self.server_relay_fanout, self.daemon_username,
+                          self.daemon_password, self.daemon_port,
+                          self.daemon_heartbeat_interval,
+                          self.daemon_heartbeat_misses, self.daemon_host_key,
+                          self.daemon_host_key_type, self.local_testdir)
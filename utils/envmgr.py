@@ -1,34 +1,77 @@
 #!/usr/bin/python3
 
 import glob
+import hashlib
+import io
+import json
 import logging
 import os
 from os import path
 import random
+import shlex
 import stat
 import string
+import tarfile
+import tempfile
+import threading
+import time
 
-from .ssh import SftpClient
+from .exceptions import DeployError
+from .fanout import DEFAULT_CONCURRENCY, DEFAULT_RELAY_FANOUT, fan_out
+from .relay import build_tree, relay
+from .ssh import SSHConnectionPool
 from .logger import get_logger
+from .testsetmgr import TestsetMgr
 
 
+DEPLOY_SFTP = 'sftp'
+DEPLOY_ARCHIVE = 'archive'
+DEPLOY_RELAY = 'relay'
+DEPLOY_MODES = (DEPLOY_SFTP, DEPLOY_ARCHIVE, DEPLOY_RELAY)
 logger = get_logger('EnvMgr', level=logging.DEBUG)
 
 
 class EnvMgr(object):
-    """Util class for deploying tests to test machines. """
+    """Util class for deploying tests to test machines. Agents and tests are
+    cached in directories shared by runs of all controllers on a server, which
+    are changed under a lock. Each run uses its own staging copy of them, so
+    that runs deploying other versions don't change files under it.
+    """
 
     _SERVER_DIR_ = "/local"
+    _MANIFEST_ = '.easytest_manifest.json'
+    # Seconds to wait for the lock of shared directory, and age of lock after
+    # which it's regarded as left by a run which died
+    _LOCK_TIMEOUT_ = 600
+    _LOCK_STALE_ = 3600
+    _LOCK_POLL_ = 0.2
+    _FILE_MODE_ = (stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP \
+                   | stat.S_IROTH | stat.S_IXOTH)
 
-    def __init__(self, servers, username, password, server_dir=None):
+    def __init__(self, servers, username, password, server_dir=None,
+                 concurrency=DEFAULT_CONCURRENCY, pool=None,
+                 deploy_mode=DEPLOY_SFTP, relay_fanout=DEFAULT_RELAY_FANOUT):
         self.servers = servers
         self.username = username
         self.password = password
+        self.concurrency = concurrency
+        self.deploy_mode = deploy_mode
+        self.relay_fanout = relay_fanout
+        if pool is None:
+            pool = SSHConnectionPool(username=username, password=password)
+        self.pool = pool
         if server_dir is None:
-            self.server_dir = EnvMgr._SERVER_DIR
+            self.server_dir = EnvMgr._SERVER_DIR_
         else:
             self.server_dir = server_dir
 
+        # Directory on test servers to which test output of this run goes,
+        # and where agents and tests of this run are staged
+        self.run_dir = path.join(self.server_dir, EnvMgr.get_unique_name())
+
+        # Digests of local files to be deployed, keyed by file path
+        self.digests = {}
+
     @staticmethod
     def get_unique_name(prefix='test_'):
         chars = ''.join([random.choice(string.ascii_lowercase) \
@@ -36,102 +79,400 @@ class EnvMgr(object):
         nums = ''.join([str(random.randint(0,9)) for _ in range(4)])
         return ''.join([prefix, chars, nums])
 
+    def _check_errors(self, action, errors):
+        """Raise DeployError reporting all servers on which 'action' failed"""
+
+        if errors:
+            msg = 'Failed to {} on servers: {}'.format(action, errors)
+            logger.error(msg)
+            raise DeployError(msg)
+
+    def file_digest(self, localf):
+        """Return sha256 digest of local file, which is computed only once per
+        run no matter how many servers the file is deployed to.
+        """
+
+        digest = self.digests.get(localf)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(localf, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            self.digests[localf] = digest
+        return digest
+
+    def forget(self, changed):
+        """Drop cached digests of local files which were modified, 'changed'
+        holds their real paths.
+        """
+
+        for localf in list(self.digests):
+            if path.realpath(localf) in changed:
+                del self.digests[localf]
+
+    @staticmethod
+    def read_manifest(sftp, remote_dir):
+        """Return the manifest of files deployed to 'remote_dir', which maps
+        their paths relative to 'remote_dir' to content digests.
+        """
+
+        remote_manifest = path.join(remote_dir, EnvMgr._MANIFEST_)
+        try:
+            with sftp.open(remote_manifest) as f:
+                return json.loads(f.read().decode('utf-8'))
+        except IOError:
+            return {}
+        except ValueError as e:
+            logger.warning('Ignore corrupted manifest %s: %s', remote_manifest,
+                           str(e))
+            return {}
+
+    @staticmethod
+    def write_manifest(sftp, remote_dir, manifest):
+        remote_manifest = path.join(remote_dir, EnvMgr._MANIFEST_)
+        tmp_manifest = remote_manifest + '.tmp'
+        with sftp.open(tmp_manifest, 'w') as f:
+            f.write(json.dumps(manifest, indent=1, sort_keys=True))
+        sftp.posix_rename(tmp_manifest, remote_manifest)
+
+    def lock_dir(self, server, remote_dir):
+        """Take the lock of shared directory 'remote_dir' on server, which is
+        a directory next to it, as mkdir is atomic. The sftp session is given
+        back between attempts, so that other servers may be deployed.
+        """
+
+        lock = remote_dir + '.lock'
+        deadline = time.time() + EnvMgr._LOCK_TIMEOUT_
+        while True:
+            with self.pool.sftp(server) as sftp:
+                EnvMgr.makedirs(sftp, path.dirname(lock))
+                try:
+                    sftp.mkdir(lock)
+                    return
+                except IOError:
+                    pass
+
+                try:
+                    age = time.time() - sftp.stat(lock).st_mtime
+                    if age > EnvMgr._LOCK_STALE_:
+                        logger.warning('Break stale lock %s:%s', server, lock)
+                        sftp.rmdir(lock)
+                        continue
+                except IOError:
+                    continue
+
+            if time.time() > deadline:
+                msg = 'Lock {}:{} is held by another run for over {} '\
+                      'seconds'.format(server, lock, EnvMgr._LOCK_TIMEOUT_)
+                raise DeployError(msg)
+            time.sleep(EnvMgr._LOCK_POLL_)
+
+    def unlock_dir(self, server, remote_dir):
+        with self.pool.sftp(server) as sftp:
+            sftp.rmdir(remote_dir + '.lock')
+
+    def stage_files(self, server, remote_dir, stage_dir):
+        """Hard link files of shared 'remote_dir' into 'stage_dir' of this run.
+        Deployed files always replace the shared ones rather than rewrite them,
+        so files staged stay the same when other runs deploy later.
+        """
+
+        cmd = 'mkdir -p {1} && cp -alf {0}/. {1}/'.format(
+            shlex.quote(remote_dir), shlex.quote(stage_dir))
+        logger.debug('Stage %s:%s to %s', server, remote_dir, stage_dir)
+        chan = self.pool.exec_command(server, cmd)
+        try:
+            status = chan.recv_exit_status()
+            if status != 0:
+                error = chan.makefile_stderr('rb').read().decode('utf-8',
+                                                                 'replace')
+                msg = 'Failed to stage {} on {}: {}'.format(remote_dir, server,
+                                                            error)
+                raise DeployError(msg)
+        finally:
+            chan.close()
+
+    def deploy_files(self, server, files, remote_dir, stage_dir):
+        """Sync 'files' to shared 'remote_dir' on server and stage them in
+        'stage_dir', holding the lock of shared directory meanwhile.
+        """
+
+        self.lock_dir(server, remote_dir)
+        try:
+            self.sync_files(server, files, remote_dir)
+            self.stage_files(server, remote_dir, stage_dir)
+        finally:
+            self.unlock_dir(server, remote_dir)
+
+    def sync_files(self, server, files, remote_dir):
+        """Make 'remote_dir' on server hold the local files in 'files', which
+        maps paths relative to 'remote_dir' to local files. Only files missing
+        or changed per the manifest stored in 'remote_dir' are copied, either
+        one by one over sftp or as a single archive stream.
+        """
+
+        with self.pool.sftp(server) as sftp:
+            EnvMgr.makedirs(sftp, remote_dir)
+            manifest = EnvMgr.read_manifest(sftp, remote_dir)
+            changed = [relpath for relpath, localf in sorted(files.items()) \
+                       if manifest.get(relpath) != self.file_digest(localf)]
+            logger.info('%d of %d files need to be copied to %s:%s',
+                        len(changed), len(files), server, remote_dir)
+            if not changed:
+                return changed
+
+            for relpath in changed:
+                manifest[relpath] = self.file_digest(files[relpath])
+
+            if self.deploy_mode == DEPLOY_ARCHIVE:
+                self.upload_archive(server, files, changed, manifest,
+                                    remote_dir)
+            else:
+                self.upload_files(sftp, server, files, changed, remote_dir)
+                EnvMgr.write_manifest(sftp, remote_dir, manifest)
+        return changed
+
+    def upload_files(self, sftp, server, files, relpaths, remote_dir):
+        """Copy files in 'relpaths' one by one over sftp, each file replaces
+        the old one by rename, which may be staged by runs.
+        """
+
+        created_dirs = set([remote_dir])
+        for relpath in relpaths:
+            localf = files[relpath]
+            remotef = path.join(remote_dir, relpath)
+            if path.dirname(remotef) not in created_dirs:
+                EnvMgr.makedirs(sftp, path.dirname(remotef))
+                created_dirs.add(path.dirname(remotef))
+            logger.debug('Copy %s to %s:%s', localf, server, remotef)
+            tmpf = remotef + '.tmp'
+            sftp.put(localf, tmpf)
+            sftp.chmod(tmpf, EnvMgr._FILE_MODE_)
+            sftp.posix_rename(tmpf, remotef)
+
+    @staticmethod
+    def write_archive(fileobj, files, relpaths, manifest):
+        """Write files in 'relpaths' and then 'manifest' as a gzipped tar stream
+        to 'fileobj'. Files keep their modes, which are made at least as
+        permissive as the ones set by sftp deployment.
+        """
+
+        def set_mode(tarinfo):
+            tarinfo.mode |= EnvMgr._FILE_MODE_
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ''
+            return tarinfo
+
+        with tarfile.open(fileobj=fileobj, mode='w|gz') as tar:
+            for relpath in relpaths:
+                tar.add(files[relpath], arcname=relpath, recursive=False,
+                        filter=set_mode)
+
+            data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+            tarinfo = tarfile.TarInfo(EnvMgr._MANIFEST_)
+            tarinfo.size = len(data)
+            tarinfo.mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP \
+                           | stat.S_IROTH
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo, io.BytesIO(data))
+
+    def upload_archive(self, server, files, relpaths, manifest, remote_dir):
+        """Stream files in 'relpaths' together with the updated manifest as a
+        single archive over one exec channel, and unpack it in 'remote_dir'.
+        """
+
+        cmd = 'mkdir -p {0} && tar -xzpf - -C {0}'.format(
+            shlex.quote(remote_dir))
+        logger.debug('Stream %d files to %s:%s', len(relpaths), server,
+                     remote_dir)
+        chan = self.pool.exec_command(server, cmd)
+        try:
+            with chan.makefile('wb') as stream:
+                EnvMgr.write_archive(stream, files, relpaths, manifest)
+            chan.shutdown_write()
+            status = chan.recv_exit_status()
+            if status != 0:
+                error = chan.makefile_stderr('rb').read().decode('utf-8',
+                                                                 'replace')
+                msg = 'Failed to unpack archive on {}: {}'.format(server, error)
+                raise DeployError(msg)
+        finally:
+            chan.close()
+
+    def relay_deploy(self, files, remote_dir, stage_dir, servers):
+        """Relay all 'files' to shared 'remote_dir' on 'servers' and stage them
+        in 'stage_dir', holding the locks of shared directory on all servers
+        meanwhile. Return a dict of errors keyed by server.
+        """
+
+        _, errors = fan_out(lambda s: self.lock_dir(s, remote_dir), servers,
+                            self.concurrency)
+        locked = [s for s in servers if s not in errors]
+        try:
+            errors.update(self.relay_files(files, remote_dir, locked))
+            staged = [s for s in locked if s not in errors]
+            stage = lambda s: self.stage_files(s, remote_dir, stage_dir)
+            errors.update(fan_out(stage, staged, self.concurrency)[1])
+        finally:
+            unlock = lambda s: self.unlock_dir(s, remote_dir)
+            fan_out(unlock, locked, self.concurrency)
+        return errors
+
+    def relay_files(self, files, remote_dir, servers):
+        """Copy all 'files' to 'remote_dir' on 'servers' by relay: the bundle
+        is streamed to a few seed servers, which forward it to further tiers.
+        Return a dict of errors keyed by server.
+        """
+
+        manifest = dict((relpath, self.file_digest(localf)) \
+                        for relpath, localf in files.items())
+        remote_bundle = path.join(self.server_dir, '.easytest_relay',
+                                  EnvMgr.get_unique_name('bundle_') + '.tar.gz')
+        agent_dir = path.join(self.server_dir, 'easytest_agent')
+        nodes = build_tree(list(servers), self.relay_fanout)
+
+        errors = {}
+        lock = threading.Lock()
+
+        def report(server, error):
+            with lock:
+                if error is None:
+                    logger.info('Relay to %s:%s succeeded', server, remote_dir)
+                else:
+                    logger.error('Relay to %s:%s failed: %s', server,
+                                 remote_dir, error)
+                    errors[server] = error
+
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as bundle:
+            EnvMgr.write_archive(bundle, files, sorted(files), manifest)
+            bundle.flush()
+            logger.info('Relay %d files to %d servers with fanout %d',
+                        len(files), len(servers), self.relay_fanout)
+            relay(self.pool, bundle.name, remote_bundle, remote_dir, agent_dir,
+                  nodes, report, self.concurrency)
+        return errors
+
+    @staticmethod
+    def agent_files():
+        """Return agent files to be deployed, keyed by their paths relative to
+        agent directory.
+        """
+
+        files = {}
+        regex = path.join(path.dirname(__name__), 'utils', '**/*.*')
+        for localf in glob.glob(regex, recursive=True):
+            if '__pycache__' not in localf:
+                files[path.join('utils', path.basename(localf))] = localf
+
+        # Agent entry and config file are located at top of agent directory
+        files['remoterun.py'] = files.pop(path.join('utils', 'remoterun.py'))
+        files['config.ini'] = path.join(path.dirname(path.abspath(__name__)),
+                                        'config.ini')
+        return files
+
+    @staticmethod
+    def test_files(testcases):
+        """Return test scripts and files used by them to be deployed, keyed
+        by their paths relative to test directory. Files keep their layout
+        relative to the tests directory.
+        """
+
+        files = {}
+        for testcase in testcases:
+            files[path.join('scripts', testcase.relpath)] = testcase.abspath
+            for relpath in TestsetMgr.get_dependencies(testcase):
+                localf = TestsetMgr.get_test_fullpath(relpath)
+                files[path.join('scripts', relpath)] = localf
+        return files
+
     def deploy_agents(self):
-        """Copy easytest agent scripts to newly created directory on target
-        servers.
+        """Copy easytest agent scripts to agent directory on target servers,
+        all servers are deployed concurrently. Only agent scripts changed since
+        last deployment are copied.
         """
 
         logger.info('Start to deploy agent scripts')
         agent_dir = path.join(self.server_dir, 'easytest_agent')
-        agent_utils_dir = path.join(self.server_dir, 'easytest_agent/utils')
-
-        mode = (stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP \
-                | stat.S_IROTH | stat.S_IXOTH)
-        for server in self.servers:
-            with SftpClient(server=server, username=self.username,
-                            password=self.password) as sftp:
-                # Create agent directory if necessary
-                try:
-                    sftp.listdir(agent_dir)
-                    logger.info('Agent scripts already exist on %s', server)
-                    continue
-                except Exception:
-                    sftp.mkdir(agent_dir)
-                    sftp.mkdir(agent_utils_dir)
-
-                regex = path.join(path.dirname(__name__), 'utils', '**/*.*')
-                for localf in glob.glob(regex, recursive=True):
-                    if '__pycache__' not in localf:
-                        remotef = path.join(agent_utils_dir,
-                                            path.basename(localf))
-                        logger.info('Copy %s to %s:%s', localf, server, remotef)
-                        sftp.put(localf, remotef)
-                        sftp.chmod(remotef, mode)
-
-                sftp.rename(path.join(agent_utils_dir, 'remoterun.py'),
-                            path.join(agent_dir, 'remoterun.py'))
-
-                # deploy config file
-                local_conf = path.join(path.dirname(path.abspath(__name__)),
-                                                    'config.ini')
-                remote_conf = path.join(agent_dir, 'config.ini')
-                logger.info('Copy %s to %s:%s', local_conf, server, remote_conf)
-                sftp.put(local_conf, remote_conf)
-                sftp.chmod(remote_conf, mode)
-
-        return agent_dir
-
-    def deploy_tests(self, test_files):
-        """Copy test scripts to newly created directory on target servers """
+        stage_dir = path.join(self.run_dir, 'agent')
+        files = EnvMgr.agent_files()
+        if self.deploy_mode == DEPLOY_RELAY:
+            errors = self.relay_deploy(files, agent_dir, stage_dir,
+                                       self.servers)
+        else:
+            deploy = lambda server: self.deploy_files(server, files, agent_dir,
+                                                      stage_dir)
+            _, errors = fan_out(deploy, self.servers, self.concurrency)
+        self._check_errors('deploy agent scripts', errors)
+        return stage_dir
+
+    @staticmethod
+    def makedirs(sftp, remote_dir):
+        """Create remote directory and its missing parents"""
+
+        try:
+            sftp.stat(remote_dir)
+            return
+        except IOError:
+            pass
+
+        parent = path.dirname(remote_dir)
+        if parent and parent != remote_dir:
+            EnvMgr.makedirs(sftp, parent)
+        sftp.mkdir(remote_dir)
+
+    def deploy_tests(self, testcases, server_tests=None):
+        """Copy test scripts to test directory on target servers concurrently,
+        the layout of scripts relative to the tests directory is kept. If
+        'server_tests' is given, it maps each server to the testcases to be
+        copied there, otherwise every server gets all 'testcases'. Only files
+        changed since last deployment are copied.
+        """
 
         logger.info('Start to deploy test scripts')
 
-        if not test_files:
+        remote_dir = path.join(self.server_dir, 'easytest_tests')
+        stage_dir = path.join(self.run_dir, 'tests')
+        if not testcases:
             logger.warning('No tests need to be deployed')
-            return
+            return stage_dir
+
+        if server_tests is None:
+            server_tests = {server: testcases for server in self.servers}
+
+        if self.deploy_mode == DEPLOY_RELAY:
+            # All servers get the same bundle, which holds all tests
+            servers = [s for s in self.servers if server_tests.get(s)]
+            errors = self.relay_deploy(EnvMgr.test_files(testcases),
+                                       remote_dir, stage_dir, servers)
+            self._check_errors('deploy test scripts', errors)
+            return stage_dir
 
-        local_bin_dir = path.join(path.dirname(test_files[0]), 'bin')
-        remote_dir = path.join(self.server_dir, EnvMgr.get_unique_name())
-        remote_scripts_dir = path.join(remote_dir, 'scripts')
-        remote_bin_dir = path.join(remote_scripts_dir, 'bin')
-        mode = (stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP \
-                | stat.S_IROTH | stat.S_IXOTH)
-        for server in self.servers:
-            with SftpClient(server=server, username=self.username,
-                            password=self.password) as sftp:
-                sftp.mkdir(remote_dir)
-                sftp.mkdir(remote_scripts_dir)
-                sftp.mkdir(remote_bin_dir)
-
-                for localf in test_files:
-                    remotef = path.join(remote_scripts_dir, path.basename(localf))
-                    logger.debug('Copy %s to %s:%s', localf, server, remotef)
-                    sftp.put(localf, remotef)
-                    sftp.chmod(remotef, mode)
-
-                search_path = path.join(local_bin_dir, '**/*')
-                logger.debug('Copy binaries used by test scripts: %s', search_path)
-                for localf in glob.glob(search_path, recursive=True):
-                    remotef = path.join(remote_bin_dir, path.basename(localf))
-                    logger.debug('Copy %s to %s:%s', localf, server, remotef)
-                    sftp.put(localf, remotef)
-                    sftp.chmod(remotef, mode)
-
-        return remote_dir
+        def deploy(server):
+            if not server_tests.get(server):
+                logger.info('No tests need to be deployed to %s', server)
+                return
+            files = EnvMgr.test_files(server_tests[server])
+            self.deploy_files(server, files, remote_dir, stage_dir)
+
+        _, errors = fan_out(deploy, self.servers, self.concurrency)
+        self._check_errors('deploy test scripts', errors)
+        return stage_dir
 
     def download(self, server_file):
-        """Download server file"""
+        """Download server file 'server:path', where server is the name the
+        server is given by user, so that its pooled connection is used.
+        """
 
         local_dir = path.join('/tmp', EnvMgr.get_unique_name())
         if not path.isdir(local_dir):
             os.makedirs(local_dir)
 
-        server, remote_file = server_file.split(':')
+        server, remote_file = server_file.split(':', 1)
         local_file = path.join(local_dir, path.basename(server_file))
         logger.info('Download %s to %s', server_file, local_file)
 
-        with SftpClient(server=server, username=self.username,
-                        password=self.password) as sftp:
+        with self.pool.sftp(server) as sftp:
             sftp.get(remote_file, local_file)
 
         return local_file
@@ -18,3 +18,11 @@ class IllegalResultError(Exception):
 
 class InvalidConfigError(Exception):
     pass
+
+
+class DeployError(Exception):
+    pass
+
+
+class ProtocolError(Exception):
+    pass
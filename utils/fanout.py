@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from .logger import get_logger
+
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_RELAY_FANOUT = 4
+logger = get_logger('FanOut', level=logging.DEBUG)
+
+
+def fan_out(func, servers, max_workers=DEFAULT_CONCURRENCY):
+    """Call func(server) for all servers on a bounded pool of threads. Return
+    a dict of results and a dict of errors, both keyed by server.
+    """
+
+    results = {}
+    errors = {}
+    if not servers:
+        return results, errors
+
+    max_workers = max(1, min(max_workers, len(servers)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {server: executor.submit(func, server) for server in servers}
+        for server, future in futures.items():
+            try:
+                results[server] = future.result()
+            except Exception as e:
+                name = getattr(func, '__name__', str(func))
+                logger.warning('%s failed on %s: %s', name, server, str(e))
+                errors[server] = str(e)
+
+    return results, errors
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+import logging
+import re
+
+from .exceptions import InvalidArgumentError
+from .logger import get_logger
+
+
+GROUP_AND = 'and'
+GROUP_OR = 'or'
+GROUP_NOT = 'not'
+REGEX_GROUP_TOKEN = re.compile(r'\s*(\(|\)|[^\s()]+)')
+logger = get_logger('GroupMgr', level=logging.DEBUG)
+
+
+class GroupExpr(object):
+    """Boolean expression of test groups, such as 'C13 and not AAA' or
+    '(net or storage) and smoke'. 'not' binds tighter than 'and', which binds
+    tighter than 'or'.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = GroupExpr.tokenize(expr)
+        self.pos = 0
+        self.tree = self._parse_or()
+        if self.pos != len(self.tokens):
+            self._error('unexpected "{}"'.format(self.tokens[self.pos]))
+
+    @staticmethod
+    def tokenize(expr):
+        tokens = []
+        pos = 0
+        expr = expr.rstrip()
+        while pos < len(expr):
+            m = REGEX_GROUP_TOKEN.match(expr, pos)
+            tokens.append(m.group(1))
+            pos = m.end()
+        return tokens
+
+    def _error(self, reason):
+        msg = 'Invalid group expression "{}": {}'.format(self.expr, reason)
+        raise InvalidArgumentError(msg)
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            self._error('unexpected end')
+        self.pos += 1
+        return token
+
+    def _parse_or(self):
+        tree = self._parse_and()
+        while self._peek() == GROUP_OR:
+            self.pos += 1
+            tree = (GROUP_OR, tree, self._parse_and())
+        return tree
+
+    def _parse_and(self):
+        tree = self._parse_not()
+        while self._peek() == GROUP_AND:
+            self.pos += 1
+            tree = (GROUP_AND, tree, self._parse_not())
+        return tree
+
+    def _parse_not(self):
+        if self._peek() == GROUP_NOT:
+            self.pos += 1
+            return (GROUP_NOT, self._parse_not())
+        return self._parse_group()
+
+    def _parse_group(self):
+        token = self._next()
+        if token == '(':
+            tree = self._parse_or()
+            if self._next() != ')':
+                self._error('missing ")"')
+            return tree
+        if token in (')', GROUP_AND, GROUP_OR, GROUP_NOT):
+            self._error('unexpected "{}"'.format(token))
+        return token
+
+    def groups(self, tree=None):
+        """Return the set of groups referenced by expression"""
+
+        if tree is None:
+            tree = self.tree
+        if isinstance(tree, str):
+            return {tree}
+        return set().union(*[self.groups(t) for t in tree[1:]])
+
+    def evaluate(self, lookup, universe, tree=None):
+        """Evaluate expression as operations on bitsets, lookup(group) returns
+        the bitset of a group, and 'universe' is the bitset of all tests.
+        """
+
+        if tree is None:
+            tree = self.tree
+        if isinstance(tree, str):
+            return lookup(tree)
+        if tree[0] == GROUP_NOT:
+            return universe & ~self.evaluate(lookup, universe, tree[1])
+
+        left = self.evaluate(lookup, universe, tree[1])
+        right = self.evaluate(lookup, universe, tree[2])
+        if tree[0] == GROUP_AND:
+            return left & right
+        return left | right
+
+
+class GroupIndex(object):
+    """Inverted index from test group to the tests in it. Tests are numbered in
+    the order they are given, and the tests of each group are kept as an int
+    bitset, so that group expressions are evaluated as bitwise operations.
+    """
+
+    def __init__(self, testcases):
+        self.testcases = list(testcases)
+        self.universe = (1 << len(self.testcases)) - 1
+        enabled = {}
+        disabled = {}
+        for i, testcase in enumerate(self.testcases):
+            for group in testcase.groups:
+                enabled.setdefault(group, []).append(i)
+            for group in testcase.disabled_groups:
+                disabled.setdefault(group, []).append(i)
+        self.enabled = {g: self._bitset(tests) for g, tests in enabled.items()}
+        self.disabled = {g: self._bitset(tests)
+                         for g, tests in disabled.items()}
+
+    def _bitset(self, indexes):
+        """Return the bitset of tests numbered by 'indexes'"""
+
+        bits = bytearray((len(self.testcases) + 7) // 8)
+        for i in indexes:
+            bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, 'little')
+
+    def enabled_tests(self, group):
+        return self.enabled.get(group, 0)
+
+    def declared_tests(self, group):
+        return self.enabled.get(group, 0) | self.disabled.get(group, 0)
+
+    def select(self, expr):
+        """Return bitsets of the tests selected by group expression 'expr' and
+        the tests skipped by it. A test is skipped if it would have been
+        selected were its disabled groups enabled.
+        """
+
+        unknown = expr.groups() - set(self.enabled) - set(self.disabled)
+        if unknown:
+            logger.warning('No test belongs to group(s) %s', sorted(unknown))
+
+        selected = expr.evaluate(self.enabled_tests, self.universe)
+        declared = expr.evaluate(self.declared_tests, self.universe)
+        return selected, declared & ~selected
+
+    def testcases_of(self, bits):
+        """Return testcases in bitset 'bits' in their original order"""
+
+        return [self.testcases[i] for i, bit in enumerate(bin(bits)[:1:-1])
+                if bit == '1']
+
+
+class GroupMgr(object):
+    """The util class for selecting tests by group expressions"""
+
+    @staticmethod
+    def parse(req_groups):
+        """Parse group expressions given by user, a test is selected if it
+        matches any of them.
+        """
+
+        # Validate each expression alone, so that errors point at it
+        exprs = ['({})'.format(GroupExpr(group).expr) for group in req_groups]
+        return GroupExpr(' {} '.format(GROUP_OR).join(exprs))
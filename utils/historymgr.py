@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+from os import path
+
+from .logger import get_logger
+from .resultmgr import TestResult
+
+
+history_dir = path.join(path.dirname(path.dirname(__file__)), 'history')
+history_file = path.join(history_dir, 'test_history.json')
+logger = get_logger('HistoryMgr', level=logging.DEBUG)
+
+
+class HistoryMgr(object):
+    """Util class for keeping the wall-clock durations and last results of past
+    test runs, which are keyed by relative path of test script.
+    """
+
+    _MAX_DURATIONS_ = 10
+
+    def __init__(self, history_file=history_file):
+        self.history_file = history_file
+        self.history = self._load()
+
+    def _load(self):
+        """Read test history from disk, a missing or corrupted history file is
+        treated as empty history.
+        """
+
+        if not path.isfile(self.history_file):
+            return {}
+
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignore test history %s: %s', self.history_file,
+                           str(e))
+            return {}
+
+    def save(self):
+        """Write test history to disk"""
+
+        os.makedirs(path.dirname(self.history_file), exist_ok=True)
+        tmp_file = self.history_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.history, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.history_file)
+        logger.debug('Test history is saved to %s', self.history_file)
+
+    def record(self, relpath, result, duration=None):
+        """Record result and duration (in seconds) of a finished test"""
+
+        if isinstance(result, TestResult):
+            result = result.value
+
+        entry = self.history.setdefault(relpath, {'durations': []})
+        entry['result'] = result
+        if duration is not None:
+            entry['durations'].append(round(float(duration), 3))
+            del entry['durations'][:-HistoryMgr._MAX_DURATIONS_]
+
+    def estimate(self, relpath, default=None):
+        """Return the expected duration of a test, which is the average of its
+        recent durations, or 'default' if the test never finished before.
+        """
+
+        durations = self.history.get(relpath, {}).get('durations')
+        if not durations:
+            return default
+        return sum(durations) / len(durations)
+
+    def failed(self, relpath):
+        """Check if a test failed or was aborted in its last run"""
+
+        result = self.history.get(relpath, {}).get('result')
+        return result in (TestResult.FAILED.value, TestResult.ABORTED.value)
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+from os import path
+
+from .logger import get_logger
+
+
+index_dir = path.join(path.dirname(path.dirname(__file__)), 'history')
+index_file = path.join(index_dir, 'test_index.json')
+logger = get_logger('IndexMgr', level=logging.DEBUG)
+
+
+class IndexMgr(object):
+    """Util class for caching parsed headers of test scripts on disk, so that
+    only new or modified scripts are parsed again. Entries are keyed by the
+    absolute path of file, and are valid as long as its mtime and size stay
+    the same.
+    """
+
+    # Bump it whenever the format of cached headers changes
+    _VERSION_ = 3
+
+    def __init__(self, index_file=index_file):
+        self.index_file = index_file
+        self.entries = self._load()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        """Read index from disk, a missing, corrupted or outdated index file is
+        treated as empty index.
+        """
+
+        if not path.isfile(self.index_file):
+            return {}
+
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignore test index %s: %s', self.index_file, str(e))
+            return {}
+
+        if not isinstance(index, dict) or \
+                index.get('version') != IndexMgr._VERSION_:
+            logger.info('Ignore test index %s of another version',
+                        self.index_file)
+            return {}
+        return index.get('entries', {})
+
+    def save(self):
+        """Write index to disk if it was changed"""
+
+        if not self.dirty:
+            return
+
+        os.makedirs(path.dirname(self.index_file), exist_ok=True)
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': IndexMgr._VERSION_, 'entries': self.entries},
+                      f, separators=(',', ':'), sort_keys=True)
+        os.replace(tmp_file, self.index_file)
+        self.dirty = False
+        logger.debug('Test index is saved to %s (%d hits, %d misses)',
+                     self.index_file, self.hits, self.misses)
+
+    @staticmethod
+    def _signature(stat):
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def lookup(self, filename, stat):
+        """Return cached headers of 'filename' whose os.stat() result is
+        'stat', or None if the file isn't indexed or was modified since.
+        """
+
+        entry = self.entries.get(filename)
+        if entry is not None and \
+                entry['signature'] == IndexMgr._signature(stat):
+            self.hits += 1
+            return entry['headers']
+
+        self.misses += 1
+        return None
+
+    def update(self, filename, stat, headers):
+        """Cache the headers parsed from 'filename' whose os.stat() result is
+        'stat'.
+        """
+
+        self.entries[filename] = {'signature': IndexMgr._signature(stat),
+                                  'headers': headers}
+        self.dirty = True
+
+    def prune(self, filenames):
+        """Drop entries of files which are not in 'filenames' any more"""
+
+        stale = set(self.entries) - set(filenames)
+        for filename in stale:
+            del self.entries[filename]
+        if stale:
+            logger.debug('Drop %d stale entries from test index', len(stale))
+            self.dirty = True
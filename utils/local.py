@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+"""Local transport, which runs easytest agents on the controller host itself
+without ssh. Files are deployed by plain file operations, commands are run by
+local shell, and agents talk to the daemon over a unix socket. Every server
+given by user is run as an agent of this host, so that tests can be run and
+scheduled without any real test server.
+"""
+
+from contextlib import contextmanager
+import io
+import os
+import shutil
+import socket
+import subprocess
+import threading
+
+from .transport import MsgConnector, MsgServer
+
+
+class LocalChannel(object):
+    """Command run by local shell, which is used like an exec channel of ssh"""
+
+    def __init__(self, cmd):
+        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def makefile(self, mode='r'):
+        if 'w' in mode:
+            return self.proc.stdin
+        if 'b' in mode:
+            return self.proc.stdout
+        return io.TextIOWrapper(self.proc.stdout, errors='replace')
+
+    def makefile_stderr(self, mode='r'):
+        if 'b' in mode:
+            return self.proc.stderr
+        return io.TextIOWrapper(self.proc.stderr, errors='replace')
+
+    def shutdown_write(self):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        for f in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            f.close()
+
+
+class LocalSftp(object):
+    """Local file operations used like a sftp session. As with sftp, files are
+    read as bytes.
+    """
+
+    def open(self, filename, mode='r'):
+        if 'r' in mode and 'b' not in mode:
+            mode += 'b'
+        return open(filename, mode)
+
+    def stat(self, filename):
+        return os.stat(filename)
+
+    def mkdir(self, dirname):
+        os.mkdir(dirname)
+
+    def rmdir(self, dirname):
+        os.rmdir(dirname)
+
+    def put(self, localpath, remotepath):
+        shutil.copyfile(localpath, remotepath)
+
+    def get(self, remotepath, localpath):
+        shutil.copyfile(remotepath, localpath)
+
+    def chmod(self, filename, mode):
+        os.chmod(filename, mode)
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(oldpath, newpath)
+
+    def close(self):
+        pass
+
+
+class LocalPool(object):
+    """Drop-in replacement of SSHConnectionPool for the local transport. All
+    servers are this host, so file sessions are taken one at a time, and files
+    deployed for one server are found up to date for the others.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+    def get_transport(self, server, reconnect=False):
+        return None
+
+    @contextmanager
+    def sftp(self, server):
+        with self.lock:
+            yield LocalSftp()
+
+    def exec_command(self, server, cmd):
+        return LocalChannel(cmd)
+
+    def close(self):
+        pass
+
+
+class UnixConnector(MsgConnector):
+    """Connection of easytest agent to daemon listening on a unix socket"""
+
+    def __init__(self, sock_path):
+        MsgConnector.__init__(self)
+        self.sock_path = sock_path
+
+    def connect(self):
+        self.logger.debug('Connect to %s', self.sock_path)
+        try:
+            self.chan = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.chan.connect(self.sock_path)
+        except OSError as e:
+            raise Exception('Failed to connect server:{}'.format(str(e)))
+        self.logger.debug('Server is connected')
+
+    def close(self):
+        if self.chan:
+            self.chan.close()
+        self.logger.info('Disconnected from %s', self.sock_path)
+
+
+class UnixServer(MsgServer):
+    """easytest daemon serving agents on this host over a unix socket"""
+
+    def __init__(self, msg_handler, sock_path, recv_handler=None):
+        MsgServer.__init__(self, msg_handler, recv_handler)
+        self.sock_path = sock_path
+
+    def address(self):
+        return self.sock_path
+
+    def listen(self):
+        # Socket left by an earlier run which didn't exit cleanly
+        if os.path.exists(self.sock_path):
+            os.remove(self.sock_path)
+
+        listensock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listensock.bind(self.sock_path)
+            listensock.listen(socket.SOMAXCONN)
+        except OSError:
+            listensock.close()
+            raise
+        return listensock
+
+    def execute(self):
+        try:
+            MsgServer.execute(self)
+        finally:
+            if os.path.exists(self.sock_path):
+                os.remove(self.sock_path)
+
+    def peer_name(self, chan):
+        return 'fd {}'.format(chan.fileno())
+
+    def response_msg(self, chan, msg):
+        if chan and chan.fileno() >= 0:
+            chan.sendall(msg)
+
+    def recv_chan(self, chan):
+        try:
+            return chan.recv(self._RECV_SIZE_)
+        except OSError:
+            return b''
+
+    def shutdown_chan(self, chan):
+        chan.close()
+
+    def accept_chan(self, connsock, addr):
+        self.add_chan(connsock)
@@ -1,39 +1,113 @@
 #!/usr/bin/python3
 
+import json
 import random
+import struct
+import threading
 import time
 
+from .exceptions import ProtocolError
+
+
+# Every message is sent as a frame: magic, protocol version and length of
+# payload, followed by payload which is a json object. Version 1 was the
+# original text protocol.
+PROTOCOL_MAGIC = b'ET'
+PROTOCOL_VERSION = 2
+MAX_FRAME_SIZE = 16 << 20
+_FRAME_HEADER_ = struct.Struct('!2sBI')
+
+# Agents send a heartbeat every this many seconds, and are declared dead by
+# daemon after missing this many heartbeats in a row
+DEFAULT_HEARTBEAT_INTERVAL = 5
+DEFAULT_HEARTBEAT_MISSES = 3
+
+
+def encode_frame(payload):
+    """Return frame carrying 'payload' bytes"""
+
+    return _FRAME_HEADER_.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION,
+                               len(payload)) + payload
+
+
+class FrameDecoder(object):
+    """Split a byte stream into payloads of frames, no matter how the stream
+    is fragmented or coalesced when received.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        """Append received 'data', and return payloads of complete frames"""
+
+        self.buf.extend(data)
+        payloads = []
+        while len(self.buf) >= _FRAME_HEADER_.size:
+            magic, version, size = _FRAME_HEADER_.unpack_from(self.buf)
+            if magic != PROTOCOL_MAGIC:
+                raise ProtocolError('Not an easytest message: {}'.format(
+                    bytes(self.buf[:16])))
+            if version != PROTOCOL_VERSION:
+                msg = 'Unsupported protocol version {}, expect {}'
+                raise ProtocolError(msg.format(version, PROTOCOL_VERSION))
+            if size > MAX_FRAME_SIZE:
+                raise ProtocolError('Message of {} bytes is too large'.format(
+                    size))
+
+            end = _FRAME_HEADER_.size + size
+            if len(self.buf) < end:
+                break
+            payloads.append(bytes(self.buf[_FRAME_HEADER_.size:end]))
+            del self.buf[:end]
+        return payloads
+
 
 class Message(object):
     def __init__(self):
         self.val = None
 
     def __str__(self):
-        return self.val.decode()
+        return self.val[_FRAME_HEADER_.size:].decode()
 
     @staticmethod
     def build_msg(**kargs):
-        msg = ''
-        for k, v in kargs.items():
-            msg += '{} {}\n'.format(k, v)
-        return bytes(msg, 'utf-8')
+        payload = json.dumps(kargs, separators=(',', ':'))
+        return encode_frame(bytes(payload, 'utf-8'))
 
     @staticmethod
     def parse_msg(msg):
-        if isinstance(msg, bytes):
-            msg = msg.decode('utf-8')
+        """Return content of message payload as a dict, or None if it's not a
+        valid payload.
+        """
+
+        try:
+            content = json.loads(msg)
+        except ValueError:
+            return None
 
-        if '\n' not in msg or ' ' not in msg:
+        if not isinstance(content, dict) or not content:
             return None
+        return content
 
-        kvs = msg.split('\n')
-        args = {}
-        for k_v in kvs:
-            if len(k_v) > 2:
-               k, v = k_v.split(' ')
-               args[k] = v
+    @staticmethod
+    def get_type(msg):
+        """Return the type of message, which is its first key, e.g. 'sync',
+        'batch', 'ack', 'next', 'task', 'heartbeat' or 'error'.
+        """
+
+        content = Message.parse_msg(msg)
+        if not content:
+            return None
+        return next(iter(content))
 
-        return args
+
+class ErrorMsg(Message):
+    """Sent by easytest daemon before it drops a connection it can't serve"""
+
+    def __init__(self, error):
+        self.error = error
+        self.val = self.build_msg(error=error)
 
 
 class SyncMsg(Message):
@@ -41,37 +115,67 @@ class SyncMsg(Message):
 
     _MSG_INITIALIZED_ = False
     _MSGID_ = 0 
+    _MSGID_LOCK_ = threading.Lock()
 
     def __init__(self, script, status, final_msg=False, msgid=None,
-                 support_bundle=None):
+                 support_bundle=None, duration=None):
         self.script = script
         self.status = status
         self.final_msg = final_msg
         self.msgid = self.get_msgid() if msgid is None else msgid
         self.support_bundle = support_bundle
-        self.val = self.build_msg(sync=self.msgid, script=script, status=status,
-                                  support_bundle=support_bundle)
+        self.duration = duration
+        self.val = self.build_msg(**self.content())
+
+    def content(self):
+        return dict(sync=self.msgid, script=self.script, status=self.status,
+                    support_bundle=self.support_bundle,
+                    duration=self.duration)
 
     @classmethod
     def get_msgid(cls):
-        if not cls._MSG_INITIALIZED_:
-            cls._MSG_INITIALIZED_ = True
-            random.seed(time.time())
-            cls._MSGID_ = random.randint(5000, 50000)
+        with cls._MSGID_LOCK_:
+            if not cls._MSG_INITIALIZED_:
+                cls._MSG_INITIALIZED_ = True
+                random.seed(time.time())
+                cls._MSGID_ = random.randint(5000, 50000)
 
-        cls._MSGID_ += 1
-        return cls._MSGID_
+            cls._MSGID_ += 1
+            return cls._MSGID_
 
     @classmethod
-    def from_msg(cls, msg):
+    def from_content(cls, content):
         final_msg = False 
-        content = Message.parse_msg(msg)
         if content['script'] == 'all' and content['status'] == 'Finished':
             final_msg = True
 
         return cls(msgid=content['sync'], script=content['script'],
                    status=content['status'], final_msg=final_msg,
-                   support_bundle=content['support_bundle'])
+                   support_bundle=content.get('support_bundle'),
+                   duration=content.get('duration'))
+
+    @classmethod
+    def from_msg(cls, msg):
+        return cls.from_content(Message.parse_msg(msg))
+
+
+class BatchMsg(Message):
+    """Many sync-up messages packed into one message, which is acknowledged
+    by one AckMsg. 'agent' is the name of the agent sending it.
+    """
+
+    def __init__(self, msgs, msgid=None, agent=None):
+        self.msgs = msgs
+        self.agent = agent
+        self.msgid = SyncMsg.get_msgid() if msgid is None else msgid
+        self.val = self.build_msg(batch=self.msgid, agent=agent,
+                                  msgs=[m.content() for m in msgs])
+
+    @classmethod
+    def from_msg(cls, msg):
+        content = Message.parse_msg(msg)
+        return cls([SyncMsg.from_content(c) for c in content['msgs']],
+                   msgid=content['batch'], agent=content.get('agent'))
 
 
 class AckMsg(Message):
@@ -79,3 +183,88 @@ class AckMsg(Message):
 
     def __init__(self, msgid):
         self.val = self.build_msg(ack=msgid)
+
+
+class NextMsg(Message):
+    """Request from easytest agent for the next test to be run, which carries
+    the cpus and memory still free on the agent's server.
+    """
+
+    def __init__(self, agent, cpus, mem, idle, msgid=None):
+        self.agent = agent
+        self.cpus = cpus
+        self.mem = mem
+        self.idle = idle
+        self.msgid = SyncMsg.get_msgid() if msgid is None else msgid
+        self.val = self.build_msg(next=self.msgid, agent=agent, cpus=cpus,
+                                  mem=mem, idle=idle)
+
+    @classmethod
+    def from_msg(cls, msg):
+        content = Message.parse_msg(msg)
+        return cls(content['agent'], content['cpus'], content['mem'],
+                   content['idle'], msgid=content['next'])
+
+
+class TaskMsg(Message):
+    """Response to NextMsg, which carries the test to be run. If no test is
+    carried, the agent should either wait for its running tests to free some
+    resources and ask again, or stop if there are no more tests for it.
+    """
+
+    def __init__(self, msgid, script=None, parallel=False, timeout=None,
+                 cpus=1, mem=0, wait=False):
+        self.msgid = msgid
+        self.script = script
+        self.parallel = parallel
+        self.timeout = timeout
+        self.cpus = cpus
+        self.mem = mem
+        self.wait = wait
+        if script is None:
+            self.val = self.build_msg(task=msgid, wait=wait)
+        else:
+            self.val = self.build_msg(task=msgid, script=script,
+                                      parallel=parallel, timeout=timeout,
+                                      cpus=cpus, mem=mem)
+
+    @classmethod
+    def from_msg(cls, msg):
+        content = Message.parse_msg(msg)
+        return cls(content['task'], script=content.get('script'),
+                   parallel=content.get('parallel', False),
+                   timeout=content.get('timeout'), cpus=content.get('cpus', 1),
+                   mem=content.get('mem', 0), wait=content.get('wait', False))
+
+
+class OutputMsg(Message):
+    """Latest lines of output of a running test, forwarded by easytest agent
+    without being acknowledged. 'skipped' is the number of bytes of output not
+    forwarded since the previous message.
+    """
+
+    def __init__(self, script, lines, skipped=0):
+        self.script = script
+        self.lines = lines
+        self.skipped = skipped
+        self.val = self.build_msg(output=script, lines=lines, skipped=skipped)
+
+    @classmethod
+    def from_msg(cls, msg):
+        content = Message.parse_msg(msg)
+        return cls(content['output'], content['lines'],
+                   content.get('skipped', 0))
+
+
+class HeartbeatMsg(Message):
+    """Sent by easytest agent periodically to tell daemon it's alive, which
+    isn't acknowledged.
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.val = self.build_msg(heartbeat=agent)
+
+    @classmethod
+    def from_msg(cls, msg):
+        return cls(Message.parse_msg(msg)['heartbeat'])
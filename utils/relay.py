@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+"""Relay deployment, which copies one bundle to a tree of test servers. The
+controller streams the bundle to a few seed servers, and each seed forwards it
+to the next tier by running this module on itself, so that the time taken
+grows with log(N) rather than N. Every server reports a line per descendant,
+which is forwarded up to the controller:
+
+        relay <server> ok
+        relay <server> failed <reason>
+"""
+
+import argparse
+import json
+import logging
+import os
+from os import path
+import shlex
+import sys
+import threading
+
+from .configmgr import ConfigMgr
+from .fanout import DEFAULT_CONCURRENCY, DEFAULT_RELAY_FANOUT, fan_out
+from .logger import get_logger
+from .ssh import SSHConnectionPool
+
+
+logger = get_logger('Relay', level=logging.DEBUG)
+
+
+def build_tree(servers, fanout=DEFAULT_RELAY_FANOUT):
+    """Arrange servers as a tree in which every node has at most 'fanout'
+    children. Return the list of top tier nodes, each node is a pair of server
+    and the list of its child nodes.
+    """
+
+    fanout = max(1, fanout)
+
+    def node(i):
+        first = (i + 1) * fanout
+        children = [node(c) for c in range(first, first + fanout)
+                    if c < len(servers)]
+        return [servers[i], children]
+
+    return [node(i) for i in range(min(fanout, len(servers)))]
+
+
+def tree_servers(nodes):
+    """Return all servers in the list of tree nodes"""
+
+    servers = []
+    for server, children in nodes:
+        servers.append(server)
+        servers.extend(tree_servers(children))
+    return servers
+
+
+def parse_report(line):
+    """Parse a report line, return (server, error) or None if the line isn't a
+    report. 'error' is None if the server was deployed.
+    """
+
+    fields = line.strip().split(' ', 3)
+    if len(fields) < 3 or fields[0] != 'relay':
+        return None
+    if fields[2] == 'ok':
+        return fields[1], None
+    return fields[1], (fields[3] if len(fields) > 3 else 'unknown error')
+
+
+def run_command(chan, output=None):
+    """Wait for command on 'chan' to exit, lines of its stdout are passed to
+    'output'. Raise exception with its stderr if the command failed.
+    """
+
+    try:
+        if output is not None:
+            for line in chan.makefile('r'):
+                output(line)
+
+        status = chan.recv_exit_status()
+        if status != 0:
+            error = chan.makefile_stderr('rb').read().decode('utf-8', 'replace')
+            raise Exception('exit {}: {}'.format(status, error.strip()))
+    finally:
+        chan.close()
+
+
+def relay(pool, bundle, remote_bundle, dest_dir, agent_dir, nodes, report,
+          concurrency=DEFAULT_CONCURRENCY):
+    """Unpack local 'bundle' to 'dest_dir' on all servers in tree 'nodes'. A
+    server having children keeps the bundle as 'remote_bundle' and forwards
+    it by the relay module in 'agent_dir'. report(server, error) is called for
+    every server in the tree.
+    """
+
+    def forward(server, children):
+        quoted_dest = shlex.quote(dest_dir)
+        quoted_bundle = shlex.quote(remote_bundle)
+        if children:
+            cmd = 'mkdir -p {} {} && cat > {} && tar -xzpf {} -C {}'.format(
+                shlex.quote(path.dirname(remote_bundle)), quoted_dest,
+                quoted_bundle, quoted_bundle, quoted_dest)
+        else:
+            cmd = 'mkdir -p {0} && tar -xzpf - -C {0}'.format(quoted_dest)
+
+        logger.info('Copy %s to %s:%s', bundle, server, dest_dir)
+        try:
+            chan = pool.exec_command(server, cmd)
+            with open(bundle, 'rb') as f, chan.makefile('wb') as stream:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    stream.write(chunk)
+            chan.shutdown_write()
+            run_command(chan)
+        except Exception as e:
+            report(server, str(e))
+            for child in tree_servers(children):
+                report(child, 'parent {} failed'.format(server))
+            return
+        report(server, None)
+
+        if not children:
+            return
+
+        logger.info('Forward %s from %s to %d servers', bundle, server,
+                    len(tree_servers(children)))
+        reported = set()
+
+        def output(line):
+            result = parse_report(line)
+            if result is not None:
+                reported.add(result[0])
+                report(*result)
+
+        cmd = 'cd {} && python3 -m utils.relay --bundle {} --dest {} '\
+              '--tree {}'.format(shlex.quote(agent_dir), quoted_bundle,
+                                 quoted_dest, shlex.quote(json.dumps(children)))
+        try:
+            run_command(pool.exec_command(server, cmd), output)
+            error = 'no report from {}'.format(server)
+        except Exception as e:
+            error = 'relay on {} failed: {}'.format(server, str(e))
+
+        for child in tree_servers(children):
+            if child not in reported:
+                report(child, error)
+
+    children = dict((server, subtree) for server, subtree in nodes)
+    fan_out(lambda server: forward(server, children[server]), list(children),
+            concurrency)
+
+
+def get_args():
+    """Construct and return supported arguments"""
+
+    desc = 'Unpack bundle locally and forward it to child servers'
+    argparser = argparse.ArgumentParser(description=desc)
+
+    argparser.add_argument('--bundle', help='The bundle to be forwarded',
+                           action='store', required=True)
+    argparser.add_argument('--dest', help='The directory where bundle is '\
+                           'unpacked on child servers', action='store',
+                           required=True)
+    argparser.add_argument('--tree', help='The child servers in json',
+                           action='store', required=True)
+    return argparser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    agent_dir = os.getcwd()
+    config_mgr = ConfigMgr(config_file=path.join(agent_dir, 'config.ini'))
+    pool = SSHConnectionPool(username=config_mgr.server_username,
+                             password=config_mgr.server_password)
+    print_lock = threading.Lock()
+
+    def report(server, error):
+        with print_lock:
+            if error is None:
+                print('relay {} ok'.format(server))
+            else:
+                error = ' '.join(error.split())
+                print('relay {} failed {}'.format(server, error))
+            sys.stdout.flush()
+
+    try:
+        relay(pool, args.bundle, args.bundle, args.dest, agent_dir,
+              json.loads(args.tree), report, config_mgr.server_concurrency)
+    finally:
+        pool.close()
+        os.remove(args.bundle)
@@ -1,47 +1,119 @@
 #!/usr/bin/python3
 
-"""The eastest agent on test server, which is responsible for running tests one
-by one, syncing up test progress with easytest, collecting, and sending back
-test result.
+"""The eastest agent on test server, which is responsible for pulling tests
+from easytest daemon, running them, syncing up test progress with easytest,
+collecting, and sending back test result. Tests declared as parallel are run
+concurrently as long as the cpus and memory they declare fit in the server,
+the others are run with the whole server to themselves.
 """ 
 
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import logging
 import os
 from os import path
+import signal
 import socket
 import subprocess
+import threading
 import time
 
 from utils.configmgr import ConfigMgr
 from utils.logger import get_logger
 from utils.exceptions import SessionBrokenError
+from utils.local import UnixConnector
 from utils.ssh import SSHConnector
-from utils.message import SyncMsg, AckMsg
+from utils.message import BatchMsg, DEFAULT_HEARTBEAT_INTERVAL, HeartbeatMsg,\
+                          Message, NextMsg, OutputMsg, SyncMsg
+from utils.message import TaskMsg
 from utils.resultmgr import make_tarfile, TestResult
+from utils.schedmgr import TestQueue
+from utils.testsetmgr import TestCase, TestsetMgr
 
 
+# Only the end of test output goes into support bundle, the whole output is
+# left in execution directory on test server
+BUNDLE_OUTPUT_BYTES = 1 << 20
 logger = get_logger('easytestagent', level=logging.DEBUG, is_agent=True)
 
 
 class EasytestAgent(object):
+    """Connection of agent to easytest daemon. Sync-up messages are queued and
+    sent in batches by a background sender, so that running tests never wait
+    for the daemon. Up to _WINDOW_ batches may be unacknowledged at the same
+    time, and a batch not acknowledged in _ACK_TIMEOUT_ seconds is sent again,
+    with the timeout doubled on every retry. A heartbeat is sent whenever
+    nothing else was sent for a while, so that daemon knows the agent is alive.
+    Responses from daemon are read by a background receiver.
+    """
 
     _CONFIG_FILE = path.join(path.dirname(path.abspath(__file__)), 'config.ini')
+    _WINDOW_ = 8
+    _MAX_BATCH_ = 256
+    _ACK_TIMEOUT_ = 30
+    _MAX_RETRIES_ = 3
+    _REQUEST_TIMEOUT_ = 300
 
-    def __init__(self, server):
+    def __init__(self, server, name=None, sock_path=None):
         self.server = server
+        self.name = socket.gethostname() if name is None else name
+        # Daemon on this host is connected by unix socket instead of ssh
+        self.sock_path = sock_path
         self.connector= None
 
+        # Guards all below, and is notified whenever any of them changes
+        self.cond = threading.Condition()
+        # Sync-up messages waiting to be sent by the next batch
+        self.outbox = deque()
+        # Batches sent but not acknowledged, msgid -> [msg, sent time, retries]
+        self.unacked = {}
+        # Responses to test requests keyed by msgid, None until they arrive
+        self.tasks = {}
+        self.error = None
+        self.closed = False
+        self.threads = []
+
+        # Both sender and test runner send messages over the channel
+        self.send_lock = threading.Lock()
+        # Heartbeat is sent if nothing else was sent for this many seconds
+        self.heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL
+        self.last_sent = time.time()
+
     def connect(self):
         logger.info('Connect to server %s', self.server)
         config_mgr = ConfigMgr(config_file=EasytestAgent._CONFIG_FILE)
-        self.connector = SSHConnector(self.server, port=config_mgr.daemon_port,
-                                      username=config_mgr.daemon_username,
-                                      password=config_mgr.daemon_password)
+        if self.sock_path is not None:
+            self.connector = UnixConnector(self.sock_path)
+        else:
+            self.connector = SSHConnector(self.server,
+                                          port=config_mgr.daemon_port,
+                                          username=config_mgr.daemon_username,
+                                          password=config_mgr.daemon_password)
+        self.heartbeat_interval = config_mgr.daemon_heartbeat_interval
         self.connector.connect()
+        self.start()
         return self
 
+    def start(self):
+        """Start background sender and receiver"""
+
+        for target in (self.send_updates, self.recv_msgs):
+            t = threading.Thread(target=target)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.connector:
+            self.connector.close()
+        for t in self.threads:
+            t.join()
+
     def open_session(self):
         t = paramiko.Transport((self.server, self.port))
         t.connect(username=self.username, password=self.password)
@@ -52,37 +124,174 @@ class EasytestAgent(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb): 
-        if self.connector:
-            self.connector.close()
+        self.close()
         logger.info('Disconnected from server %s', self.server)
 
-    def update_test_progress(self, testscript, status, support_bundle=None):
-        msg = SyncMsg(testscript, status.value, support_bundle=support_bundle)
+    def send(self, msg):
+        with self.send_lock:
+            self.connector.send(msg)
+            self.last_sent = time.time()
+
+    def fail(self, error):
+        """Stop syncing up with daemon, the error is raised to test runner by
+        the next request or flush.
+        """
+
+        logger.error('Sync-up with server is broken: %s', str(error))
+        with self.cond:
+            if self.error is None:
+                self.error = error
+            self.cond.notify_all()
+
+    def check_error(self):
+        if self.error is not None:
+            error = 'Can\'t sync up with server: {}'.format(self.error)
+            raise SessionBrokenError(error)
+
+    def congested(self):
+        """Check if daemon is behind on acknowledging sync-up messages"""
+
+        with self.cond:
+            return len(self.unacked) >= self._WINDOW_
+
+    def forward_output(self, testscript, lines, skipped=0):
+        """Forward latest output lines of test to daemon, which is done on a
+        best effort basis and never retransmitted.
+        """
+
+        self.send(OutputMsg(testscript, lines, skipped).val)
+
+    def queue(self, msg):
         logger.info('Sync-up status: %s', str(msg))
-        exp_resp = AckMsg(msg.msgid)
-        self.notify(msg.val, exp_resp.val)
+        with self.cond:
+            self.outbox.append(msg)
+            self.cond.notify_all()
+
+    def update_test_progress(self, testscript, status, support_bundle=None,
+                             duration=None):
+        """Queue test status to be synced up with easytest daemon"""
+
+        self.queue(SyncMsg(testscript, status.value,
+                           support_bundle=support_bundle, duration=duration))
 
     def notify_tests_done(self):
         logger.info('Notify server all tests are finished')
-        msg = SyncMsg('all', TestResult.FINISHED.value)
-        resp = AckMsg(msg.msgid)
-        self.notify(msg.val, resp.val)
+        self.queue(SyncMsg('all', TestResult.FINISHED.value))
+
+    def flush(self, timeout=None):
+        """Wait until all queued sync-up messages are acknowledged"""
+
+        with self.cond:
+            done = self.cond.wait_for(lambda: self.error is not None or
+                                      not (self.outbox or self.unacked),
+                                      timeout=timeout)
+            self.check_error()
+            if not done:
+                raise SessionBrokenError('Sync-up with server timed out')
+
+    def request_test(self, cpus, mem, idle):
+        """Ask easytest daemon for the next test which fits in the free 'cpus'
+        and 'mem' of this server.
+        """
+
+        msg = NextMsg(self.name, cpus, mem, idle)
+        with self.cond:
+            self.check_error()
+            self.tasks[msg.msgid] = None
+        self.send(msg.val)
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.error is not None or
+                               self.tasks[msg.msgid] is not None,
+                               timeout=self._REQUEST_TIMEOUT_)
+            task = self.tasks.pop(msg.msgid)
+            self.check_error()
+        if task is None:
+            raise SessionBrokenError('No response to request for next test')
 
-    def notify(self, req, exp_ack):
-        retries = 0
-        MAX_RETRIES = 3
+        logger.info('Got next test: %s', task.script)
+        return task
 
-        self.connector.send(req)
-        ack = self.connector.recv()
-        while retries < MAX_RETRIES and ack != exp_ack:
-            retries += 1
-            logger.debug('Sync-up failed, expect: %s, actual: %s', exp_ack, ack)
-            self.connector.send(req)
-            self.connector.recv(ack)
+    def next_batches(self):
+        """Return batches to be sent, which are unacknowledged batches timed
+        out and a new batch of queued messages if the window isn't full. The
+        caller holds 'cond'.
+        """
 
-        if retries == MAX_RETRIES:
-            error = 'Can\'t sync up with server ({})'.format(req)
-            raise SessionBroeknError(error)
+        batches = []
+        now = time.time()
+        for msgid, entry in self.unacked.items():
+            batch, sent, retries = entry
+            if now - sent < self._ACK_TIMEOUT_ * (1 << retries):
+                continue
+            if retries >= self._MAX_RETRIES_:
+                error = 'No ack of message {} after {} retries'
+                raise SessionBrokenError(error.format(msgid, retries))
+            logger.debug('Resend message %s', msgid)
+            entry[1:] = [now, retries + 1]
+            batches.append(batch)
+
+        if self.outbox and len(self.unacked) < self._WINDOW_:
+            count = min(len(self.outbox), self._MAX_BATCH_)
+            batch = BatchMsg([self.outbox.popleft() for _ in range(count)],
+                             agent=self.name)
+            self.unacked[batch.msgid] = [batch, now, 0]
+            batches.append(batch)
+        return batches
+
+    def send_updates(self):
+        """Background sender of sync-up messages and heartbeats"""
+
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.error is not None or
+                                   self.closed or (self.outbox and
+                                   len(self.unacked) < self._WINDOW_),
+                                   timeout=min(1, self.heartbeat_interval))
+                if self.error is not None or self.closed:
+                    return
+                try:
+                    batches = self.next_batches()
+                except SessionBrokenError as e:
+                    batches = None
+                    error = e
+
+            if batches is None:
+                self.fail(error)
+                return
+            if not batches and \
+                    time.time() - self.last_sent >= self.heartbeat_interval:
+                batches = [HeartbeatMsg(self.name)]
+
+            for batch in batches:
+                try:
+                    self.send(batch.val)
+                except Exception as e:
+                    self.fail(e)
+                    return
+
+    def recv_msgs(self):
+        """Background receiver of responses from easytest daemon"""
+
+        while True:
+            try:
+                msg = self.connector.recv()
+            except Exception as e:
+                if not self.closed:
+                    self.fail(e)
+                return
+
+            msg_type = Message.get_type(msg)
+            with self.cond:
+                if msg_type == 'ack':
+                    self.unacked.pop(Message.parse_msg(msg)['ack'], None)
+                elif msg_type == 'task':
+                    task = TaskMsg.from_msg(msg)
+                    if task.msgid in self.tasks:
+                        self.tasks[task.msgid] = task
+                else:
+                    logger.warning('Ignore unexpected message: %s', msg)
+                self.cond.notify_all()
 
 
 def get_args():
@@ -93,55 +302,356 @@ def get_args():
 
     argparser.add_argument('--testdir', help='The server directory where test '\
                            'scripts are located', action='store', required=True)
+    argparser.add_argument('--outdir', help='The server directory where test '\
+                           'output goes, default to "out" under testdir',
+                           action='store')
     argparser.add_argument('--sync', help='indicate if to sync with easy with '\
                            'easytest', action='store_true')
     argparser.add_argument('--server', help='the easytest server with which to '\
                            'sync the test progress', action='store')
+    argparser.add_argument('--timeout', help='the default seconds a test may '\
+                           'run before being aborted', action='store',
+                           type=float)
+    argparser.add_argument('--socket', help='the unix socket of easytest '\
+                           'daemon on this host, which is used instead of '\
+                           'ssh to "--server"', action='store')
+    argparser.add_argument('--name', help='the name by which easytest daemon '\
+                           'knows this server', action='store')
+    argparser.add_argument('--workers', help='the maximum number of parallel '\
+                           'tests to run at the same time, default to the '\
+                           'number of cores', action='store', type=int,
+                           default=os.cpu_count())
+    argparser.add_argument('--forward-output', help='forward the latest lines '\
+                           'of test output to easytest daemon',
+                           action='store_true')
     args = argparser.parse_args()
     if not args.sync and args.server or args.sync and not args.server:
         raise SystemExit('option "--server" and "--sync" must be used together')
     return args
 
 
-def run_tests(agent, testdir, sync_daemon):
-    """Run all tests under directory 'testdir' """
+def get_server_resources():
+    """Return the number of cpus and bytes of memory of this server"""
 
-    test_script_dir = path.join(testdir, 'scripts')
-    search_path = path.join(test_script_dir, '**/*.*')
-    for testscript in glob.glob(search_path, recursive=True):
-        exec_dir = path.join(testdir, 'out', path.basename(testscript))
-        if not path.isdir(exec_dir):
-            os.makedirs(exec_dir)
-
-        status = TestResult.RUNNING
-        test_rel_path = path.relpath(testscript, test_script_dir)
-        agent.update_test_progress(test_rel_path, status)
+    cpus = 0
+    with open('/proc/cpuinfo') as f:
+        for line in f:
+            if line.startswith('processor'):
+                cpus += 1
+
+    mem = 0
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                mem = int(line.split()[1]) * 1024
+                break
+
+    return (cpus or os.cpu_count() or 1), mem
+
+
+class LocalTestSource(object):
+    """Tests found under the scripts directory of test server, which is used
+    when the agent doesn't sync with easytest daemon.
+    """
+
+    def __init__(self, test_script_dir):
+        search_path = path.join(test_script_dir, '**/*.*')
+        testcases = [TestsetMgr.get_testcase(testscript, test_script_dir)
+                     for testscript in glob.glob(search_path, recursive=True)]
+        self.queue = TestQueue(shared_tests=testcases)
+        self.exhausted = False
+
+    def next_test(self, cpus, mem, idle):
+        testcase = self.queue.next_test(None, cpus, mem, idle)
+        self.exhausted = testcase is None and not self.queue.pending(None)
+        return testcase
+
+
+class DaemonTestSource(object):
+    """Tests pulled one by one from the queue held by easytest daemon"""
+
+    def __init__(self, agent, test_script_dir):
+        self.agent = agent
+        self.test_script_dir = test_script_dir
+        self.exhausted = False
+
+    def next_test(self, cpus, mem, idle):
+        task = self.agent.request_test(cpus, mem, idle)
+        if task.script is None:
+            self.exhausted = not task.wait
+            return None
+
+        testscript = path.join(self.test_script_dir, task.script)
+        testcase = TestCase(testscript, task.script)
+        testcase.set_parallel(task.parallel)
+        testcase.set_timeout(task.timeout)
+        testcase.set_cpus(task.cpus)
+        testcase.set_mem(task.mem)
+        return testcase
+
+
+class OutputTailer(object):
+    """Forward lines appended to the output file of a running test to easytest
+    daemon. At most _MAX_BYTES_ bytes are forwarded every _INTERVAL_ seconds,
+    older output beyond that is skipped, and nothing is forwarded while daemon
+    is behind on sync-up messages.
+    """
+
+    _INTERVAL_ = 1
+    _MAX_BYTES_ = 16 << 10
+
+    def __init__(self, agent, testscript, output_file):
+        self.agent = agent
+        self.testscript = testscript
+        self.output_file = output_file
+        self.pos = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Forward output not forwarded yet and stop"""
+
+        self.stopped.set()
+        self.thread.join()
+
+    def forward(self, final=False):
         try:
-            logger.info('Run %s in directory %s', testscript, exec_dir)
-            subprocess.check_output([testscript], cwd=exec_dir)
-            status = TestResult.FINISHED
-        except subprocess.CalledProcessError as e:
-            logger.info('Test failed: %s', str(e))
-            status = TestResult.FAILED
+            size = os.path.getsize(self.output_file)
+        except OSError:
+            return
+
+        skipped = max(0, size - self.pos - self._MAX_BYTES_)
+        if size <= self.pos or (self.agent.congested() and not final):
+            return
+
+        with open(self.output_file, 'rb') as f:
+            f.seek(self.pos + skipped)
+            data = f.read(size - self.pos - skipped)
+
+        # Partial last line is forwarded next time unless test is done
+        end = len(data) if final else data.rfind(b'\n') + 1
+        if end <= 0:
+            return
+        self.pos += skipped + end
+        lines = data[:end].decode('utf-8', 'replace').splitlines()
+        try:
+            self.agent.forward_output(self.testscript, lines, skipped)
         except Exception as e:
-            logger.info('Test failed: %s', str(e))
-            status = TestResult.FAILED
+            logger.warning('Failed to forward output of %s: %s',
+                           self.testscript, str(e))
+
+    def run(self):
+        while not self.stopped.wait(self._INTERVAL_):
+            self.forward()
+        self.forward(final=True)
+
 
-        support_bundle = None
-        if status == TestResult.FAILED:
-            support_bundle = exec_dir + '.tar.gz'
-            make_tarfile(support_bundle, exec_dir)
-            ip_addr = socket.gethostbyname(socket.gethostname())
-            support_bundle = ip_addr + ':' + support_bundle
+class TestRunner(object):
+    """Run tests handed out by a test source. Parallel tests are packed so
+    that the cpus and memory they declare stay within what the server has,
+    other tests are run only when no other test is running.
+    """
+
+    _WAIT_INTERVAL_ = 1
+
+    def __init__(self, agent, outdir, sync_daemon, workers=None, timeout=None,
+                 forward_output=False):
+        self.agent = agent
+        self.outdir = outdir
+        self.sync_daemon = sync_daemon
+        self.forward_output = forward_output
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.timeout = timeout
+        self.total_cpus, self.total_mem = get_server_resources()
+        self.free_cpus = self.total_cpus
+        self.free_mem = self.total_mem
+        self.running = 0
+        # Increased whenever a test finishes and frees its resources
+        self.finished = 0
+        self.cond = threading.Condition()
+
+    def reserve(self, testcase):
+        """Return cpus and memory reserved for running 'testcase', a test
+        which isn't parallel reserves the whole server.
+        """
+
+        if not testcase.parallel:
+            return self.total_cpus, self.total_mem
+        return (min(testcase.cpus, self.total_cpus),
+                min(testcase.mem, self.total_mem))
+
+    def run(self, source):
+        logger.info('Run tests with %d workers, %d cpus and %d bytes memory',
+                    self.workers, self.total_cpus, self.total_mem)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                # Only ask for the next test when there are free resources
+                with self.cond:
+                    self.cond.wait_for(lambda: self.running < self.workers and
+                                       self.free_cpus > 0)
+                    cpus, mem = self.free_cpus, self.free_mem
+                    idle = (self.running == 0)
+                    finished = self.finished
+
+                testcase = source.next_test(cpus, mem, idle)
+                if testcase is None:
+                    if source.exhausted:
+                        break
+
+                    # Nothing fits for now, ask again once a test finishes
+                    with self.cond:
+                        self.cond.wait_for(lambda: self.finished != finished,
+                                           timeout=self._WAIT_INTERVAL_)
+                    continue
+
+                if testcase.timeout is None:
+                    testcase.set_timeout(self.timeout)
+
+                cpus, mem = self.reserve(testcase)
+                with self.cond:
+                    self.running += 1
+                    self.free_cpus -= cpus
+                    self.free_mem -= mem
+                executor.submit(self.run_reserved, testcase, cpus, mem)
+
+    def run_reserved(self, testcase, cpus, mem):
+        try:
+            run_test(self.agent, testcase, self.outdir, self.sync_daemon,
+                     self.forward_output)
+        except Exception as e:
+            logger.error('Failed to run %s: %s', testcase.relpath, str(e))
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.free_cpus += cpus
+                self.free_mem += mem
+                self.finished += 1
+                self.cond.notify_all()
+
+
+def kill_process_group(proc, grace_period=5):
+    """Terminate the process group led by 'proc'. Members of the group still
+    alive after 'grace_period' seconds are killed, even if the leader itself
+    has exited.
+    """
+
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        proc.wait()
+        return
+
+    deadline = time.time() + grace_period
+    while time.time() < deadline:
+        # Reap the leader, so that only live members keep the group around
+        proc.poll()
+        try:
+            os.killpg(proc.pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def run_test(agent, testcase, outdir, sync_daemon, forward_output=False):
+    """Run a single test script in its own process group and sync up its
+    progress with easytest. The test is aborted if it runs longer than its
+    timeout. Its stdout and stderr go to file 'output.log' in its execution
+    directory as they are produced, and are forwarded to easytest daemon as
+    well if 'forward_output' is set.
+    """
+
+    testscript = testcase.abspath
+    test_rel_path = testcase.relpath
+    exec_dir = path.join(outdir, test_rel_path)
+    if not path.isdir(exec_dir):
+        os.makedirs(exec_dir)
+
+    status = TestResult.RUNNING
+    if sync_daemon:
+        agent.update_test_progress(test_rel_path, status)
+    output_file = path.join(exec_dir, 'output.log')
+    tailer = None
+    start_time = time.time()
+    try:
+        logger.info('Run %s in directory %s', testscript, exec_dir)
+        with open(output_file, 'wb') as output:
+            proc = subprocess.Popen([testscript], cwd=exec_dir, stdout=output,
+                                    stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        if sync_daemon and forward_output:
+            tailer = OutputTailer(agent, test_rel_path, output_file).start()
+        try:
+            proc.wait(timeout=testcase.timeout)
+            if proc.returncode == 0:
+                status = TestResult.FINISHED
+            else:
+                logger.info('Test failed: %s exited with %d', testscript,
+                            proc.returncode)
+                status = TestResult.FAILED
+        except subprocess.TimeoutExpired:
+            logger.info('Test timed out after %s seconds: %s',
+                        testcase.timeout, testscript)
+            kill_process_group(proc)
+            status = TestResult.ABORTED
+    except Exception as e:
+        logger.info('Test failed: %s', str(e))
+        status = TestResult.FAILED
+    duration = time.time() - start_time
+    if tailer is not None:
+        tailer.stop()
+
+    support_bundle = None
+    if status in (TestResult.FAILED, TestResult.ABORTED):
+        support_bundle = exec_dir + '.tar.gz'
+        make_tarfile(support_bundle, exec_dir,
+                     tails={'output.log': BUNDLE_OUTPUT_BYTES})
+        # Prefixed by agent name, which is the server known by easytest
+        support_bundle = agent.name + ':' + support_bundle
+
+    if sync_daemon:
+        agent.update_test_progress(test_rel_path, status, support_bundle,
+                                   duration)
+
+    return status
+
+
+def run_tests(agent, testdir, sync_daemon, workers=None, timeout=None,
+              outdir=None, forward_output=False):
+    """Run tests pulled from easytest daemon, or all tests under directory
+    'testdir' if the agent doesn't sync with easytest daemon. Test output goes
+    to 'outdir', which defaults to directory 'out' under 'testdir'.
+    """
+
+    if outdir is None:
+        outdir = path.join(testdir, 'out')
+
+    test_script_dir = path.join(testdir, 'scripts')
+    if sync_daemon:
+        source = DaemonTestSource(agent, test_script_dir)
+    else:
+        source = LocalTestSource(test_script_dir)
 
-        if sync_daemon:
-            agent.update_test_progress(test_rel_path, status, support_bundle)
+    TestRunner(agent, outdir, sync_daemon, workers, timeout,
+               forward_output).run(source)
 
     if sync_daemon:
         agent.notify_tests_done()
+        agent.flush()
 
 
 if __name__ == '__main__':
     args = get_args()
-    with EasytestAgent(args.server) as agent:
-        run_tests(agent, args.testdir, args.sync)
+    with EasytestAgent(args.server, args.name, args.socket) as agent:
+        run_tests(agent, args.testdir, args.sync, args.workers, args.timeout,
+                  args.outdir, args.forward_output)
@@ -1,24 +1,50 @@
 #!/usr/bin/python3
 
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import logging
 import os
 from os import path
 import tarfile
+import threading
+import time
 
 from .exceptions import IllegalResultError
-from .message import SyncMsg, AckMsg
-from .logger import get_logger
+from .message import AckMsg, BatchMsg, Message, OutputMsg, SyncMsg
+from .logger import get_logger, log_dir
 
 
 logger = get_logger('ResultMgr', level=logging.DEBUG)
+# Support bundles of failed tests downloaded at the same time
+DOWNLOAD_WORKERS = 4
 
 
-def make_tarfile(output_file, src_dir):
-    """Create tar.gz file 'output_file' from 'src_dir' """
+def make_tarfile(output_file, src_dir, tails=None):
+    """Create tar.gz file 'output_file' from 'src_dir'. 'tails' maps paths of
+    files relative to 'src_dir' to the number of bytes kept from their end, so
+    that huge logs don't blow up the archive.
+    """
+
+    tails = tails or {}
+    arcname = os.path.basename(src_dir)
+    skipped = set(path.join(arcname, f) for f in tails)
+
     with tarfile.open(output_file, 'w:gz') as tar:
-        tar.add(src_dir, arcname=os.path.basename(src_dir))
+        tar.add(src_dir, arcname=arcname,
+                filter=lambda t: None if t.name in skipped else t)
+
+        for relpath, max_bytes in tails.items():
+            filename = path.join(src_dir, relpath)
+            if not path.isfile(filename):
+                continue
+            tarinfo = tar.gettarinfo(filename, path.join(arcname, relpath))
+            with open(filename, 'rb') as f:
+                if tarinfo.size > max_bytes:
+                    f.seek(tarinfo.size - max_bytes)
+                    tarinfo.size = max_bytes
+                tar.addfile(tarinfo, f)
 
 
 class TestResult(Enum):
@@ -33,14 +59,148 @@ class TestResult(Enum):
 class ResultMgr(object):
     """Util class for managing status update of test cases."""
 
-    def __init__(self, testcases, term_mgr, env_mgr):
-        self.tests_done = False
+    def __init__(self, testcases, term_mgr, env_mgr, servers=(), history=None,
+                 tail_lines=0, follow=None):
         self.term_mgr = term_mgr 
         self.env_mgr = env_mgr
+        self.history = history
+
+        # Results are updated by both easytest daemon and watch mode
+        self.lock = threading.RLock()
+        # Notified once the agent of any server reports all its tests finished
+        self.done_cond = threading.Condition(self.lock)
+        # Servers whose agent hasn't reported all its tests finished
+        self.pending_servers = set(servers)
+        # Tests handed out to each server but not reported done yet
+        self.outstanding = dict((s, set()) for s in servers)
+        # When each server's agent was last heard from, and servers whose
+        # agent was declared dead
+        self.last_seen = dict((s, time.time()) for s in servers)
+        self.dead = set()
+        # Ids of sync-up messages handled, keyed by channel, so that messages
+        # resent by agents are acknowledged but not handled again
+        self.synced = {}
 
+        # Last 'tail_lines' lines of output of running or failed tests
+        self.tail_lines = tail_lines
+        self.tails = {}
+        # The test whose output is shown live and saved to 'follow_file'
+        self.follow = follow
+        self.follow_file = None
+        if follow is not None:
+            self.follow_file = path.join(log_dir, 'follow',
+                                         follow.replace('/', '_') + '.log')
+        # Support bundles are downloaded apart from the daemon's channel
+        # handlers, so that slow downloads don't hold up messages of agents
+        self.downloads = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
         self.results = {}
-        for testcase in testcases:
-            self.results[testcase.relpath] = testcase
+        self.add_tests(testcases)
+
+    def add_tests(self, testcases):
+        """Track results of 'testcases', which replace tracked testcases of
+        the same script, and show the tests added in terminal.
+        """
+
+        with self.lock:
+            for testcase in testcases:
+                self.results[testcase.relpath] = testcase
+            self.term_mgr.add_tests([t.relpath for t in testcases])
+
+    @property
+    def tests_done(self):
+        with self.lock:
+            return not self.pending_servers
+
+    def expect(self, server, script):
+        """Record that test 'script' is handed out to the agent of 'server',
+        which must report it done before finishing.
+        """
+
+        with self.lock:
+            self.outstanding.setdefault(server, set()).add(script)
+
+    def beat(self, server):
+        """Record that the agent of 'server' is alive"""
+
+        with self.lock:
+            self.last_seen[server] = time.time()
+
+    def reset_beats(self):
+        """Start counting missed heartbeats of all servers from now on"""
+
+        with self.lock:
+            for server in self.last_seen:
+                self.last_seen[server] = time.time()
+
+    def silent_servers(self, timeout):
+        """Return pending servers whose agent wasn't heard from in 'timeout'
+        seconds.
+        """
+
+        deadline = time.time() - timeout
+        with self.lock:
+            return [s for s in self.pending_servers
+                    if self.last_seen.get(s, 0) < deadline]
+
+    def running_servers(self):
+        """Return servers whose agent is still running tests"""
+
+        with self.lock:
+            return set(self.pending_servers)
+
+    def busy_servers(self):
+        """Return running servers which have tests handed out but not
+        reported done yet.
+        """
+
+        with self.lock:
+            return set(s for s in self.pending_servers
+                       if self.outstanding.get(s))
+
+    def is_dead(self, server):
+        with self.lock:
+            return server in self.dead
+
+    def kill_server(self, server):
+        """Declare the agent of 'server' dead, the tests it's running are
+        aborted and further messages from it are ignored.
+        """
+
+        with self.lock:
+            self.dead.add(server)
+            self.finish_server(server)
+
+    def finish_server(self, server):
+        """Mark the agent of 'server' as finished. Tests handed out to it but
+        never reported done are marked as aborted, as their results are lost.
+        """
+
+        with self.lock:
+            if server not in self.pending_servers:
+                if server not in self.dead:
+                    logger.warning('Unexpected final sync-up from %s', server)
+                return
+
+            lost = sorted(self.outstanding.pop(server, set()))
+            if lost:
+                logger.error('%d tests on %s are not reported: %s', len(lost),
+                             server, lost)
+            for script in lost:
+                self.update(script, TestResult.ABORTED)
+
+            self.pending_servers.discard(server)
+            logger.info('All tests on %s are finished, %d servers pending',
+                        server, len(self.pending_servers))
+            self.done_cond.notify_all()
+
+    def wait_done(self, timeout=None):
+        """Block until agents of all servers report their tests finished, or
+        'timeout' seconds pass. Return whether all are finished.
+        """
+
+        with self.lock:
+            return self.done_cond.wait_for(lambda: not self.pending_servers,
+                                           timeout=timeout)
 
     def sync_skipped_tests(self):
         """Some tests belong to requested group but are marked as 'disabled',
@@ -54,23 +214,89 @@ class ResultMgr(object):
                 self.update(test_rel_path, testcase.result)
         
     def sync_result(self, server, chan, msg):
-        """Response to test progress sync-up requests from easytest agent."""
+        """Response to test progress sync-up requests from easytest agent.
+        Requests from different agents may be handled concurrently.
+        """
 
-        sync = SyncMsg.from_msg(msg)
-        logger.debug('Receive sync update from %s: %s', chan.getpeername(), str(sync))
-        tests_done = False
-        if sync.final_msg:
-            tests_done = True 
+        if Message.get_type(msg) == 'batch':
+            sync = BatchMsg.from_msg(msg)
+            syncs = sync.msgs
+            agent = sync.agent
         else:
-            self.update(sync.script, sync.status,
-                        remote_support_bundle=sync.support_bundle)
+            sync = SyncMsg.from_msg(msg)
+            syncs = [sync]
+            agent = None
+
+        with self.lock:
+            synced = self.synced.setdefault(chan, set())
+            if sync.msgid in synced:
+                logger.debug('Ignore resent message %s', sync.msgid)
+                syncs = []
+            elif agent in self.dead:
+                logger.warning('Ignore message %s from dead agent %s',
+                               sync.msgid, agent)
+                syncs = []
+            synced.add(sync.msgid)
+            if agent is not None:
+                self.last_seen[agent] = time.time()
+
+        finals = []
+        for s in syncs:
+            logger.debug('Receive sync update from %s: %s',
+                         chan.getpeername(), str(s))
+            if s.final_msg:
+                finals.append(s)
+                continue
+
+            self.update(s.script, s.status,
+                        remote_support_bundle=s.support_bundle,
+                        duration=s.duration)
+            if s.status not in (TestResult.RUNNING.value,
+                                TestResult.NOTRUN.value):
+                with self.lock:
+                    self.outstanding.get(agent, set()).discard(s.script)
 
         ack = AckMsg(sync.msgid)
         server.response_msg(chan, ack.val)
-        self.tests_done = tests_done
 
-    def update(self, script, status, remote_support_bundle=None):
-        """Update test result to terminal"""
+        # Finish the agent only after its tests are acknowledged
+        if finals:
+            self.finish_server(agent)
+
+    def sync_output(self, server, chan, msg):
+        """Keep output lines forwarded by easytest agent, which isn't
+        acknowledged.
+        """
+
+        output = OutputMsg.from_msg(msg)
+        lines = output.lines
+        if output.skipped:
+            lines = ['... {} bytes skipped ...'.format(output.skipped)] + lines
+
+        with self.lock:
+            test = self.results.get(output.script)
+            if test is None:
+                return
+
+            # Output may arrive after the test is reported done
+            if self.tail_lines > 0 and test.result not in (TestResult.FINISHED,
+                                                           TestResult.SKIPPED):
+                tail = self.tails.setdefault(output.script,
+                                             deque(maxlen=self.tail_lines))
+                tail.extend(lines)
+
+            if output.script == self.follow and lines:
+                os.makedirs(path.dirname(self.follow_file), exist_ok=True)
+                with open(self.follow_file, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+                self.term_mgr.show_output(output.script, lines[-1])
+
+    def update(self, script, status, remote_support_bundle=None,
+               duration=None):
+        """Update test result to terminal, and record it to test history once
+        the test is done. Support bundle of failed test is downloaded in the
+        background, and shown once it's downloaded.
+        """
 
         if not isinstance(status,  TestResult):
             try:
@@ -78,23 +304,65 @@ class ResultMgr(object):
             except Exception:
                 error = 'Set result of {} to {}'.format(script, status)
                 raise IllegalResultError(error)
-        
-        test = self.results[script]
-        if script in self.results:
+
+        with self.lock:
+            test = self.results.get(script)
+            if test is None:
+                return
+
             test.result = status
-            if status == TestResult.FAILED:
-                if remote_support_bundle is not None:
-                    test.remote_failure_pack = remote_support_bundle
-                    try:
-                        test.local_failure_pack = \
-                            self.env_mgr.download(remote_support_bundle)
-                    except Exception as e:
-                        logger.warning('Can\'t download %s: %s',
-                                       remote_support_bundle, str(e))
+            if status in (TestResult.FAILED, TestResult.ABORTED) and \
+                    remote_support_bundle is not None:
+                test.remote_failure_pack = remote_support_bundle
+                test.local_failure_pack = None
+                self.downloads.submit(self.download_bundle, test,
+                                      remote_support_bundle)
+
+            if self.history is not None and status in (TestResult.FINISHED,
+                    TestResult.FAILED, TestResult.ABORTED):
+                self.history.record(script, status, duration)
+
+            # Output is only kept for failed tests once they are done
+            if status in (TestResult.FINISHED, TestResult.SKIPPED,
+                          TestResult.NOTRUN):
+                self.tails.pop(script, None)
 
             self.term_mgr.update_test_status(script, status,
                                              test.local_failure_pack)
 
+    def download_bundle(self, test, remote_support_bundle):
+        """Download support bundle of failed test, and show it unless the
+        test was re-run in the meantime.
+        """
+
+        try:
+            local_failure_pack = self.env_mgr.download(remote_support_bundle)
+        except Exception as e:
+            logger.warning('Can\'t download %s: %s', remote_support_bundle,
+                           str(e))
+            return
+
+        with self.lock:
+            if self.results.get(test.relpath) is not test or \
+                    test.remote_failure_pack != remote_support_bundle:
+                return
+            test.local_failure_pack = local_failure_pack
+            self.term_mgr.update_test_status(test.relpath, test.result,
+                                             local_failure_pack)
+
+    def wait_downloads(self):
+        """Block until support bundles being downloaded are all done"""
+
+        self.downloads.shutdown(wait=True)
+
+    def failed_tails(self):
+        """Return kept output lines of failed or aborted tests"""
+
+        with self.lock:
+            return {script: list(tail) for script, tail in self.tails.items()
+                    if self.results[script].result in (TestResult.FAILED,
+                                                       TestResult.ABORTED)}
+
     def count(self, status):
         return sum([1 for t in self.results.values() if t.result == status])
 
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+from collections import deque
+import heapq
+import logging
+import threading
+
+from .logger import get_logger
+
+
+DISTRIBUTE_ALL = 'all'
+DISTRIBUTE_SHARD = 'shard'
+DISTRIBUTE_QUEUE = 'queue'
+DISTRIBUTE_MODES = (DISTRIBUTE_ALL, DISTRIBUTE_SHARD, DISTRIBUTE_QUEUE)
+SCHEDULE_GLOB = 'glob'
+SCHEDULE_LPT = 'lpt'
+SCHEDULE_FAILED_FIRST = 'failed-first'
+SCHEDULE_MODES = (SCHEDULE_GLOB, SCHEDULE_LPT, SCHEDULE_FAILED_FIRST)
+logger = get_logger('SchedMgr', level=logging.DEBUG)
+
+
+class TestQueue(object):
+    """Tests pending to be run, which are held by easytest daemon and pulled by
+    easytest agents. An agent is handed out tests from its own queue first, then
+    from the queue shared by all agents.
+    """
+
+    def __init__(self, server_tests=None, shared_tests=None):
+        self.lock = threading.Lock()
+        self.server_tests = {}
+        for server, tests in (server_tests or {}).items():
+            self.server_tests[server] = deque(tests)
+        self.shared_tests = deque(shared_tests or [])
+
+    def next_test(self, server, cpus=None, mem=None, idle=True):
+        """Pop and return the first test for 'server' which fits in its free
+        'cpus' and 'mem', or None if no test fits. Any test fits an idle server.
+        """
+
+        with self.lock:
+            for tests in (self.server_tests.get(server), self.shared_tests):
+                if not tests:
+                    continue
+                for testcase in tests:
+                    if testcase.fits(cpus, mem, idle):
+                        tests.remove(testcase)
+                        return testcase
+            return None
+
+    def add(self, server_tests=None, shared_tests=None):
+        """Queue more tests, tests which are still queued aren't added again"""
+
+        with self.lock:
+            for server, tests in (server_tests or {}).items():
+                queue = self.server_tests.setdefault(server, deque())
+                queued = set(t.relpath for t in queue)
+                queue.extend(t for t in tests if t.relpath not in queued)
+            queued = set(t.relpath for t in self.shared_tests)
+            self.shared_tests.extend(t for t in (shared_tests or [])
+                                     if t.relpath not in queued)
+
+    def take(self, server):
+        """Remove the queue of 'server' and return tests still in it"""
+
+        with self.lock:
+            return list(self.server_tests.pop(server, []))
+
+    def pending(self, server):
+        """Check if there are still tests to be run by 'server'"""
+
+        with self.lock:
+            return bool(self.server_tests.get(server) or self.shared_tests)
+
+
+class SchedMgr(object):
+    """The util class for deciding which test server runs which tests"""
+
+    @staticmethod
+    def estimates(testcases, history):
+        """Return a dict which maps relative path of each test to its expected
+        duration. Tests without history are assumed to be as long as the
+        longest known test, so that they don't start last.
+        """
+
+        known = [history.estimate(t.relpath) for t in testcases]
+        default = max([d for d in known if d is not None], default=0)
+        return {t.relpath: (d if d is not None else default)
+                for t, d in zip(testcases, known)}
+
+    @staticmethod
+    def order(testcases, schedule=SCHEDULE_GLOB, history=None):
+        """Return testcases in the order they should be run. With schedule
+        'lpt' the longest tests go first, with schedule 'failed-first' the
+        tests failed in last run go first, followed by the others longest
+        first. Schedule 'glob' keeps the order in which tests were found.
+        """
+
+        if schedule == SCHEDULE_GLOB or history is None:
+            return list(testcases)
+
+        estimates = SchedMgr.estimates(testcases, history)
+        if schedule == SCHEDULE_FAILED_FIRST:
+            key = lambda t: (not history.failed(t.relpath), -estimates[t.relpath])
+        else:
+            key = lambda t: -estimates[t.relpath]
+        return sorted(testcases, key=key)
+
+    @staticmethod
+    def shard(testcases, servers, history=None):
+        """Split testcases among servers, so that each test is run exactly once
+        on the whole fleet. Without history tests are split in round robin,
+        otherwise each test goes to the server with the least expected load.
+        """
+
+        server_tests = {server: [] for server in servers}
+        if history is None:
+            for i, testcase in enumerate(testcases):
+                server_tests[servers[i % len(servers)]].append(testcase)
+            return server_tests
+
+        estimates = SchedMgr.estimates(testcases, history)
+        loads = [(0, i, server) for i, server in enumerate(servers)]
+        for testcase in testcases:
+            load, i, server = heapq.heappop(loads)
+            server_tests[server].append(testcase)
+            heapq.heappush(loads, (load + estimates[testcase.relpath], i,
+                                   server))
+        return server_tests
+
+    @staticmethod
+    def distribute(testcases, servers, mode=DISTRIBUTE_ALL, history=None):
+        """Return a dict which maps each server to the testcases deployed to
+        it. With mode 'all' every server runs every test, with mode 'shard'
+        every test is run by one server only, with mode 'queue' every server
+        gets all tests but each test is run by whichever server pulls it first.
+        """
+
+        if mode == DISTRIBUTE_SHARD:
+            server_tests = SchedMgr.shard(testcases, servers, history)
+        else:
+            server_tests = {server: list(testcases) for server in servers}
+
+        for server, tests in server_tests.items():
+            logger.info('Tests assigned to %s: %s', server,
+                        str([t.relpath for t in tests]))
+        return server_tests
+
+    @staticmethod
+    def requeue(queue, testcases, server_tests, mode=DISTRIBUTE_ALL):
+        """Add testcases to the queue made by make_queue(), 'server_tests' is
+        returned by distribute().
+        """
+
+        if mode == DISTRIBUTE_QUEUE:
+            queue.add(shared_tests=testcases)
+        else:
+            queue.add(server_tests=server_tests)
+
+    @staticmethod
+    def make_queue(testcases, server_tests, mode=DISTRIBUTE_ALL):
+        """Return the queue from which agents pull tests, 'server_tests' is
+        returned by distribute().
+        """
+
+        if mode == DISTRIBUTE_QUEUE:
+            return TestQueue(shared_tests=testcases)
+        return TestQueue(server_tests=server_tests)
@@ -1,14 +1,24 @@
 #!/usr/bin/python3
 
+from contextlib import contextmanager
 import logging
+import os
+from os import path
 import paramiko
-import re
 import socket
 import threading
-import time
 
-from .message import AckMsg
+from .exceptions import InvalidConfigError
 from .logger import get_logger
+from .transport import MsgConnector, MsgServer
+
+
+# Types of key which easytest daemon may use as its host key, generating an
+# ecdsa key takes far less time than a rsa key
+HOST_KEY_RSA = 'rsa'
+HOST_KEY_ECDSA = 'ecdsa'
+HOST_KEY_CLASSES = {HOST_KEY_RSA: paramiko.RSAKey,
+                    HOST_KEY_ECDSA: paramiko.ECDSAKey}
 
 
 class SftpClient(object):
@@ -58,17 +68,126 @@ class SSHClient:
         self.logger.debug('Disconnected from %s:%s', self.server, self.port)
 
 
-class SSHConnector(object):
-    _MAX_MSG_SIZE_ = 2048
+class SSHConnectionPool(object):
+    """Keep one authenticated transport per server for the whole run, sftp
+    sessions and exec channels are opened from the cached transport. A broken
+    transport is detected by health check and reconnected transparently.
+    """
+
+    _KEEPALIVE_ = 30
+
+    def __init__(self, username, password, port=22, timeout=5):
+        self.username = username
+        self.password = password
+        self.port = port
+        self.timeout = timeout
+        self.transports = {}
+        self.server_locks = {}
+        self.lock = threading.Lock()
+        self.logger = get_logger('SSHConnectionPool', level=logging.DEBUG)
+
+    def _server_lock(self, server):
+        with self.lock:
+            if server not in self.server_locks:
+                self.server_locks[server] = threading.Lock()
+            return self.server_locks[server]
+
+    def _connect(self, server):
+        self.logger.debug('Connect to %s:%d', server, self.port)
+        sock = socket.create_connection((server, self.port),
+                                        timeout=self.timeout)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.set_keepalive(self._KEEPALIVE_)
+            transport.connect(username=self.username, password=self.password)
+        except Exception:
+            transport.close()
+            raise
+        return transport
+
+    @staticmethod
+    def is_healthy(transport):
+        """Check if 'transport' is still authenticated and writable"""
+
+        if transport is None or not transport.is_active() or \
+                not transport.is_authenticated():
+            return False
+
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def get_transport(self, server, reconnect=False):
+        """Return the cached transport to 'server', a new one is created if
+        there is none yet, or if the cached one is broken or 'reconnect' is set.
+        """
+
+        with self._server_lock(server):
+            transport = self.transports.get(server)
+            if reconnect or not self.is_healthy(transport):
+                if transport is not None:
+                    self.logger.info('Reconnect to %s', server)
+                    transport.close()
+                transport = self._connect(server)
+                self.transports[server] = transport
+            return transport
+
+    def _open(self, server, opener):
+        """Open a channel by 'opener' on the transport to 'server', reconnect
+        and retry once if the transport turns out to be broken. Other errors,
+        e.g. too many sessions open on a healthy transport, are raised as is,
+        as the transport is shared by channels of other threads.
+        """
+
+        transport = self.get_transport(server)
+        try:
+            return opener(transport)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            self.logger.debug('Channel to %s failed: %s', server, str(e))
+            if self.is_healthy(transport):
+                raise
+            return opener(self.get_transport(server))
+
+    @contextmanager
+    def sftp(self, server):
+        """Open a sftp session to 'server' on its cached transport"""
+
+        sftp = self._open(server, paramiko.SFTPClient.from_transport)
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+
+    def exec_command(self, server, cmd):
+        """Run 'cmd' on 'server' and return the channel it runs on"""
+
+        def opener(transport):
+            chan = transport.open_session()
+            chan.exec_command(cmd)
+            return chan
+
+        return self._open(server, opener)
+
+    def close(self):
+        """Close all cached transports"""
+
+        with self.lock:
+            for server, transport in self.transports.items():
+                transport.close()
+                self.logger.debug('Disconnected from %s:%d', server, self.port)
+            self.transports.clear()
+
 
+class SSHConnector(MsgConnector):
     def __init__(self, server, username, password, port=22):
+        MsgConnector.__init__(self)
         self.server = server
         self.port = port 
         self.username = username
         self.password = password
         self.transport = None
-        self.chan = None
-        self.logger = get_logger('SSHConnector', level=logging.DEBUG)
 
     def connect(self):
         self.logger.debug('Connect to %s:%d', self.server, self.port)
@@ -87,122 +206,111 @@ class SSHConnector(object):
             self.transport.close()
         self.logger.info('Disconnected from %s:%d', self.server, self.port)
 
-    def send(self, msg):
-        if self.chan and self.chan.send_ready():
-            self.chan.send(msg)
 
-    def recv(self):
-        if self.chan:
-            msg = self.chan.recv(SSHConnector._MAX_MSG_SIZE_)
-            return msg
-        return None
-
-    def __enter__(self):
-        self.connect()
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb): 
-        self.close()
-        self.logger.debug('Disconnected from %s:%s', self.server, self.port)
+class SSHServer(MsgServer, paramiko.server.ServerInterface):
+    """easytest daemon serving agents on other servers over ssh"""
 
+    _RSA_KEY_BITS_ = 2048
+    _HANDSHAKE_TIMEOUT_ = 30
 
-class SSHServer(paramiko.server.ServerInterface):
-
-    _MAX_MSG_SIZE_ = 2048 
-
-    def __init__(self, msg_handler, username, password, port=17258):
-        self.msg_handler = msg_handler
+    def __init__(self, msg_handler, username, password, port=17258,
+                 host_key=None, recv_handler=None):
+        MsgServer.__init__(self, msg_handler, recv_handler)
         self.username = username
         self.password = password
         self.port = port 
-        self.server_key = paramiko.RSAKey.generate(self._MAX_MSG_SIZE_)
-        self.sock_thread = None
-        self.chan_thread = None
-        self.chans = {} 
-        self.chan_lock = threading.Lock()
-        self._exit = False
-        self.logger = get_logger('SSHServer', level=logging.DEBUG)
-
-    def execute(self):
-        self.sock_thread = threading.Thread(target=self.handle_connect_req)
-        self.sock_thread.setDaemon(True)
-        self.sock_thread.start()
-
-        self.chan_thread = threading.Thread(target=self.process_msg)
-        self.chan_thread.setDaemon(True)
-        self.chan_thread.start()
-
-        self.logger.info('Server is listening on *.*:{}'.format(self.port))
-        self.sock_thread.join()
-        self.chan_thread.join()
-        self.logger.info('Server is stopped'.format(self.port))
-
-    def stop(self):
-        self._exit = True
+        self.server_key = host_key
+        if host_key is None:
+            self.server_key = SSHServer.generate_host_key(HOST_KEY_RSA)
+
+    @staticmethod
+    def generate_host_key(key_type):
+        if key_type not in HOST_KEY_CLASSES:
+            msg = 'Unsupported host key type {}, expect one of {}'.format(
+                key_type, sorted(HOST_KEY_CLASSES))
+            raise InvalidConfigError(msg)
+        if key_type == HOST_KEY_RSA:
+            return paramiko.RSAKey.generate(SSHServer._RSA_KEY_BITS_)
+        return HOST_KEY_CLASSES[key_type].generate()
+
+    @staticmethod
+    def load_host_key(key_file, key_type=HOST_KEY_RSA):
+        """Return host key of 'key_type' cached in 'key_file'. A new key is
+        generated and cached if the file is missing, unreadable or holds a key
+        of another type.
+        """
+
+        logger = get_logger('SSHServer', level=logging.DEBUG)
+        key_class = HOST_KEY_CLASSES.get(key_type)
+        if key_class is not None and path.isfile(key_file):
+            try:
+                return key_class.from_private_key_file(key_file)
+            except (OSError, paramiko.SSHException) as e:
+                logger.warning('Ignore host key %s: %s', key_file, str(e))
+
+        logger.info('Generate %s host key to %s', key_type, key_file)
+        key = SSHServer.generate_host_key(key_type)
+        os.makedirs(path.dirname(key_file), mode=0o700, exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(key_file, os.getpid())
+        key.write_private_key_file(tmp_file)
+        os.chmod(tmp_file, 0o600)
+        os.replace(tmp_file, key_file)
+        return key
+
+    def address(self):
+        return '*.*:{}'.format(self.port)
+
+    def listen(self):
+        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listensock.bind(('', self.port))
+            listensock.listen(socket.SOMAXCONN)
+        except OSError:
+            listensock.close()
+            raise
+        return listensock
 
     def response_msg(self, chan, msg):
-        if chan and chan.send_ready():
-            chan.send(msg)
-
-    def process_msg(self):
-        while True:
-            need_sleep = True 
-            self.chan_lock.acquire()
-            for transport in list(self.chans.keys()):
-                if not transport.is_active():
-                    self.chans.pop(transport)
-                    continue
-                
-                chan = self.chans[transport]
-                if chan and chan.recv_ready():
-                    msg = chan.recv(self._MAX_MSG_SIZE_)
-                    self.msg_handler(self, chan, msg)
-                    need_sleep = False
-
-            self.chan_lock.release()
-
-            if self._exit:
-                break
-
-            if need_sleep:
-                time.sleep(1)
-
-        # Close all active tranports/channels
-        self.chan_lock.acquire()
-        for transport in list(self.chans.keys()):
-            if transport and transport.is_active():
-                transport.close()
-            del self.chans[transport]
+        if chan and not chan.closed:
+            chan.sendall(msg)
+
+    def recv_chan(self, chan):
+        if chan.recv_ready():
+            data = chan.recv(self._RECV_SIZE_)
+            if data:
+                return data
+
+        if chan.closed or chan.eof_received or \
+                not chan.get_transport().is_active():
+            return b''
+        return None
 
-    def handle_connect_req(self):
-        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listensock.bind(('', self.port))
-        listensock.listen(5)
+    def shutdown_chan(self, chan):
+        transport = chan.get_transport()
+        chan.close()
+        if transport.is_active():
+            transport.close()
 
-        listensock.settimeout(1)
-        while True:
-            try:
-                connsock, addr = listensock.accept()
-            except socket.timeout:
-                if self._exit:
-                    break
-                else:
-                    continue 
-            except Exception as e:
-                break
-
-            transport = paramiko.transport.Transport(connsock)
+    def accept_chan(self, connsock, addr):
+        """Start ssh server on accepted connection, and wait for the channel
+        opened by easytest agent. It's done in its own thread, so that a slow
+        agent doesn't hold up others.
+        """
+
+        transport = paramiko.transport.Transport(connsock)
+        try:
             transport.add_server_key(self.server_key)
             transport.start_server(server=self)
+            chan = transport.accept(self._HANDSHAKE_TIMEOUT_)
+        except Exception as e:
+            self.logger.warning('Failed to accept %s: %s', addr, str(e))
+            chan = None
 
-            chan = transport.accept()
-            self.chan_lock.acquire()
-            self.chans[transport] = chan
-            self.chan_lock.release()
-
-        listensock.close()
-
+        if chan is None:
+            transport.close()
+            return
+        self.add_chan(chan)
 
     def check_allowed_auths(self, username):
         if username == self._DEFAULT_USERNAME_:
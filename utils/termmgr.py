@@ -29,10 +29,14 @@ class TermMgr:
 
         # Save test script and the line number where it's printed out
         self.test_positions = dict()
+        # Save the latest status and support bundle printed for test
+        self.test_states = dict()
 
         # The relative paths of all tests to be run, we don't need absolute path
         # because it's different between local and test machines
         self.rel_test_paths = rel_test_paths
+        # Same paths as a set, for looking up tests quickly
+        self.test_path_set = set(rel_test_paths)
 
         self.max_path_len = max([len(p) for p in self.rel_test_paths])
         self.term_attr = None
@@ -57,6 +61,20 @@ class TermMgr:
         if (oldx, oldy) != (x, y):
             TermOps.print_at(oldx, oldy, '\r')
 
+    def show_output(self, test, line):
+        """Show the latest output line of a followed test in Prompt Zone"""
+
+        msg = '{}: {}'.format(test, line.expandtabs())[:MAX_COLS - 1]
+        TermMgr.print_prompt(msg.ljust(MAX_COLS - 1))
+
+    def print_tails(self, tails):
+        """Print out the last output lines kept for failed tests"""
+
+        for test, lines in sorted(tails.items()):
+            print('==== Last {} lines of {} ===='.format(len(lines), test))
+            for line in lines:
+                print(line)
+
     def summarize(self, msg):
         """Print out the final summary of test result"""
 
@@ -84,6 +102,37 @@ class TermMgr:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.restore_term()
 
+    def add_tests(self, rel_test_paths):
+        """Show more tests, which are added after tests started. Tests printed
+        already are aligned again if a longer path is added.
+        """
+
+        max_path_len = self.max_path_len
+        for test_path in rel_test_paths:
+            if test_path not in self.test_path_set:
+                self.test_path_set.add(test_path)
+                self.rel_test_paths.append(test_path)
+                max_path_len = max(max_path_len, len(test_path))
+
+        if max_path_len != self.max_path_len:
+            self.max_path_len = max_path_len
+            self.redraw()
+
+    def redraw(self):
+        """Print out tests at their saved positions again"""
+
+        if not self.test_positions:
+            return
+
+        for test, (x, y) in self.test_positions.items():
+            # Lines scrolled out of terminal can't be updated
+            if x < 1:
+                continue
+            status, support_bundle = self.test_states[test]
+            msg = self.formatted_test_status_str(test, status, support_bundle)
+            TermOps.print_at(x, y, msg)
+        self.restore_cursor_pos()
+
     @classmethod
     def test_result_color(cls, test_result):
         """Get color that will be used for printing out specific test result"""
@@ -122,7 +171,8 @@ class TermMgr:
         script_part = self.formatted_path_str(test)
         delim_part = self.formatted_delimiter_str(test)
         status_part = self.formatted_status_str(status)
-        if status == TestResult.FAILED and support_bundle is not None:
+        if status in (TestResult.FAILED, TestResult.ABORTED) and \
+                support_bundle is not None:
             support_bundle_part = ' --- ' + support_bundle
         else:
             support_bundle_part = ''
@@ -157,6 +207,7 @@ class TermMgr:
 
         # Save the position where to print the information
         self.test_positions[test] = (x, y)
+        self.test_states[test] = (status, None)
 
         # Format and output test status
         msg = self.formatted_test_status_str(test, status)
@@ -178,7 +229,7 @@ class TermMgr:
         """Update test status to terminal"""
 
         # Invalid script, ignore it
-        if test not in self.rel_test_paths:
+        if test not in self.test_path_set:
             return
 
         # It's the 1st status update, forward it to print_test_status()
@@ -192,6 +243,7 @@ class TermMgr:
         # Update test status
         logger.debug('Update test status (%s, %s), position (%d, %s)',
                      test, status.value, x, y)
+        self.test_states[test] = (status, support_bundle)
         msg = self.formatted_test_status_str(test, status, support_bundle)
         TermOps.print_at(x, y, msg)
 
@@ -1,20 +1,29 @@
 #!/usr/bin/python3
 
 import logging
+import os
 from os import path
 import socket
 import threading
-import time
 
+from .changemgr import ChangeMgr
 from .configmgr import ConfigMgr
-from .envmgr import EnvMgr
-from .exceptions import InvalidArgumentError
+from .envmgr import DEPLOY_SFTP, EnvMgr
+from .exceptions import DeployError, InvalidArgumentError
+from .fanout import fan_out
+from .historymgr import HistoryMgr
+from .indexmgr import IndexMgr
+from .local import LocalPool, UnixServer
 from .logger import get_logger
-from .message import SyncMsg
+from .message import HeartbeatMsg, Message, NextMsg, TaskMsg
 from .termmgr import TermMgr
 from .resultmgr import ResultMgr, TestResult
-from .ssh import SSHClient, SSHServer
+from .schedmgr import DISTRIBUTE_ALL, DISTRIBUTE_SHARD, SCHEDULE_GLOB, \
+                       SchedMgr
+from .ssh import SSHConnectionPool, SSHServer
 from .testsetmgr import TestsetMgr
+from .transport import TRANSPORT_LOCAL, TRANSPORT_SSH
+from .watchmgr import WatchMgr
 
 
 logger = get_logger('TestMgr', level=logging.DEBUG)
@@ -25,50 +34,379 @@ class TestMgr(object):
     start and serialize the whole test procedure
     """
 
+    _DAEMON_START_TIMEOUT_ = 30
+    # Seconds between checks whether deferred tests can be re-run
+    _DEFER_CHECK_INTERVAL_ = 2
 
-    def __init__(self, tests=None, groups=None, servers=None):
+    def __init__(self, tests=None, groups=None, servers=None,
+                 distribute=DISTRIBUTE_ALL, schedule=SCHEDULE_GLOB,
+                 timeout=None, deploy_mode=DEPLOY_SFTP, watch=False,
+                 changed_since=None, explain_selection=False, follow=None,
+                 tail_lines=0, transport=TRANSPORT_SSH):
         self.tests = tests
         self.groups = groups
         self.servers = servers
+        self.distribute = distribute
+        self.schedule = schedule
+        self.timeout = timeout
+        self.deploy_mode = deploy_mode
+        self.watch = watch
+        self.changed_since = changed_since
+        self.explain_selection = explain_selection
+        self.follow = follow
+        self.tail_lines = tail_lines
+        self.transport = transport
 
+        # Agents are kept waiting for more tests while tests are watched
+        self.watching = watch
+        # Agents are kept waiting for more tests while tests of dead servers
+        # are moved to them, agents let go are never given more tests
+        self.assign_lock = threading.Lock()
+        self.reassigning = 0
+        self.released = set()
+        # Changed tests which are re-run once their current run is over
+        self.deferred = set()
         self.testcases = None
+        self.test_queue = None
+        self.result_mgr = None
         self.daemon = None
         self.daemon_ip = socket.gethostbyname(socket.gethostname())
 
         self.config_mgr = ConfigMgr()
+        self.history = HistoryMgr()
+        self.index = IndexMgr()
+
+        if transport == TRANSPORT_LOCAL:
+            # Servers are agents on this host, which talk to daemon over a
+            # unix socket
+            self.pool = LocalPool()
+            self.server_dir = self.config_mgr.local_testdir
+            self.daemon_socket = path.join(self.server_dir,
+                                           'daemon_{}.sock'.format(os.getpid()))
+        else:
+            # One ssh transport per server is reused during the whole run
+            self.pool = SSHConnectionPool(
+                username=self.config_mgr.server_username,
+                password=self.config_mgr.server_password)
+            self.server_dir = self.config_mgr.server_testdir
+            self.daemon_socket = None
 
     def check_server_connectivity(self):
-        """Check if requested server is reachable"""
+        """Check if requested server is reachable, all servers are checked
+        concurrently.
+        """
 
         logger.info('Check connectivity of test servers')
-        invalid_servers = {} 
-        for server in self.servers:
-            try:
-                with SSHClient(server=server,
-                               username=self.config_mgr.server_username,
-                               password=self.config_mgr.server_password):
-                   pass
-            except Exception as e:
-                invalid_servers[server] = str(e)
 
+        _, invalid_servers = fan_out(self.pool.get_transport, self.servers,
+                                     self.config_mgr.server_concurrency)
         if len(invalid_servers) > 0:
             msg = 'Servers can\'t be connected: {}'.format(invalid_servers)
             raise InvalidArgumentError(msg)
 
-    def start_daemon(self, msg_handler):
+    def launch_agents(self, servers, remote_test_dir, remote_run_dir):
+        """Start easytest agent on test servers concurrently, test output goes
+        to 'remote_run_dir'.
+        """
+
+        fmt = 'cd {}; nohup {} --testdir {} --outdir {} --sync --server {} '\
+              '--name {}{} >/dev/null 2>&1 &'
+        options = ''
+        if self.follow is not None or self.tail_lines > 0:
+            options += ' --forward-output'
+        if self.daemon_socket is not None:
+            options += ' --socket {}'.format(self.daemon_socket)
+        agent_script = path.join(self.remote_agent_dir, 'remoterun.py')
+
+        def launch(server):
+            # Agents on the same host don't share output directory
+            remote_out_dir = path.join(remote_run_dir, 'out')
+            if self.transport == TRANSPORT_LOCAL:
+                remote_out_dir = path.join(remote_run_dir, server, 'out')
+            cmd = fmt.format(self.remote_agent_dir, agent_script,
+                             remote_test_dir, remote_out_dir, self.daemon_ip,
+                             server, options)
+            logger.debug('Run tests on {}, cmd:{}'.format(server, cmd))
+            chan = self.pool.exec_command(server, cmd)
+            try:
+                chan.recv_exit_status()
+            finally:
+                chan.close()
+
+        _, errors = fan_out(launch, servers, self.config_mgr.server_concurrency)
+        if errors:
+            msg = 'Failed to start agents on servers: {}'.format(errors)
+            raise DeployError(msg)
+
+    def start_daemon(self, msg_handler, recv_handler=None):
         logger.info('Start easytest daemon ...')
-        self.daemon = SSHServer(msg_handler=msg_handler,
-                                username=self.config_mgr.daemon_username,
-                                password=self.config_mgr.daemon_password,
-                                port=self.config_mgr.daemon_port)
+        if self.daemon_socket is not None:
+            os.makedirs(path.dirname(self.daemon_socket), exist_ok=True)
+            self.daemon = UnixServer(msg_handler, self.daemon_socket,
+                                     recv_handler=recv_handler)
+        else:
+            host_key = SSHServer.load_host_key(
+                self.config_mgr.daemon_host_key,
+                self.config_mgr.daemon_host_key_type)
+            self.daemon = SSHServer(msg_handler=msg_handler,
+                                    username=self.config_mgr.daemon_username,
+                                    password=self.config_mgr.daemon_password,
+                                    port=self.config_mgr.daemon_port,
+                                    host_key=host_key,
+                                    recv_handler=recv_handler)
         t = threading.Thread(target=self.daemon.execute)
         t.setDaemon(True)
         t.start()
 
-        # Make sure daemon thread is up before existing this function
-        time.sleep(1)
+        # Make sure daemon is listening before agents are started
+        self.daemon.wait_ready(timeout=self._DAEMON_START_TIMEOUT_)
         return t 
 
+    def receive_msg(self, server, chan, msg):
+        """Record agents alive as soon as their messages arrive, rather than
+        when the messages are handled, which may wait for earlier messages of
+        the same channel. Heartbeats are handled here, and aren't queued.
+        """
+
+        content = Message.parse_msg(msg)
+        if not content:
+            return False
+
+        msg_type = next(iter(content))
+        if msg_type == 'heartbeat':
+            self.result_mgr.beat(HeartbeatMsg.from_msg(msg).agent)
+            return True
+        if content.get('agent') is not None:
+            self.result_mgr.beat(content['agent'])
+        return False
+
+    def handle_msg(self, server, chan, msg):
+        """Dispatch messages from easytest agents: requests for the next test
+        are served from the test queue, others are test progress sync-ups.
+        """
+
+        msg_type = Message.get_type(msg)
+        if msg_type == 'next':
+            req = NextMsg.from_msg(msg)
+            dead = self.result_mgr.is_dead(req.agent)
+            testcase = None
+            if not dead:
+                testcase = self.test_queue.next_test(req.agent, req.cpus,
+                                                     req.mem, req.idle)
+            if testcase is None:
+                # Let the agent wait if its remaining tests don't fit for now,
+                # or if changed tests or tests of servers which may die may be
+                # handed out later
+                with self.assign_lock:
+                    wait = not dead and (self.watching or self.reassigning > 0
+                                         or self.test_queue.pending(req.agent)
+                                         or self.peers_busy(req.agent))
+                    if not wait:
+                        self.released.add(req.agent)
+                resp = TaskMsg(req.msgid, wait=wait)
+            else:
+                logger.debug('Hand out %s to %s', testcase.relpath, req.agent)
+                self.result_mgr.expect(req.agent, testcase.relpath)
+                timeout = testcase.timeout
+                if timeout is None:
+                    timeout = self.timeout
+                resp = TaskMsg(req.msgid, script=testcase.relpath,
+                               parallel=testcase.parallel, timeout=timeout,
+                               cpus=testcase.cpus, mem=testcase.mem)
+            server.response_msg(chan, resp.val)
+        elif msg_type == 'output':
+            self.result_mgr.sync_output(server, chan, msg)
+        else:
+            self.result_mgr.sync_result(server, chan, msg)
+
+    def sched_history(self):
+        if self.schedule == SCHEDULE_GLOB:
+            return None
+        return self.history
+
+    def collect_tests(self):
+        """Collect tests per user input, only tests affected by files changed
+        since git revision 'changed_since' are collected if it's given.
+        """
+
+        changed = None
+        if self.changed_since is not None:
+            changed = ChangeMgr.changed_files(self.changed_since,
+                                              TestsetMgr._TEST_ROOT_)
+
+        testcases = TestsetMgr.get_tests(self.tests, self.groups, self.index,
+                                         changed)
+        self.index.save()
+        return testcases
+
+    def explain(self):
+        """Print out which tests are selected and why, without running them"""
+
+        testcases = self.collect_tests()
+        for line in TestsetMgr.explain(testcases):
+            print(line)
+        print('{} tests are selected'.format(len(testcases)))
+
+    def affected_tests(self, testcases, changed):
+        """Return testcases whose scripts or dependencies are in 'changed',
+        or which were deferred earlier. Tests still queued or running are
+        deferred, and returned once they are done.
+        """
+
+        tests = []
+        for testcase in testcases:
+            # Skipped tests aren't re-run
+            if testcase.result != TestResult.NOTRUN:
+                continue
+            if testcase.relpath not in self.deferred and \
+                    not TestsetMgr.change_reasons(testcase, changed):
+                continue
+
+            tracked = self.result_mgr.results.get(testcase.relpath)
+            if tracked is not None and tracked.result in (TestResult.NOTRUN,
+                                                          TestResult.RUNNING):
+                self.deferred.add(testcase.relpath)
+                continue
+            self.deferred.discard(testcase.relpath)
+            tests.append(testcase)
+        return tests
+
+    def deferred_done(self):
+        """Check if any deferred test is done with its current run"""
+
+        for relpath in self.deferred:
+            tracked = self.result_mgr.results.get(relpath)
+            if tracked is None or tracked.result not in (TestResult.NOTRUN,
+                                                         TestResult.RUNNING):
+                return True
+        return False
+
+    def rerun_tests(self, env_mgr, changed):
+        """Redeploy and queue again the tests affected by 'changed' files.
+        Tests are collected again, so that new scripts or changed headers are
+        taken into account.
+        """
+
+        if not changed and not self.deferred_done():
+            return
+
+        try:
+            testcases = self.collect_tests()
+        except Exception as e:
+            TermMgr.print_prompt('Can\'t collect tests: {}'.format(e))
+            logger.warning('Can\'t collect tests: %s', str(e))
+            return
+
+        if changed:
+            env_mgr.forget(changed)
+        tests = self.affected_tests(testcases, changed)
+        if not tests:
+            return
+
+        TermMgr.print_prompt('Re-running {} changed tests...'.format(len(tests)))
+        tests = SchedMgr.order(tests, self.schedule, self.history)
+        servers = [s for s in self.servers if not self.result_mgr.is_dead(s)]
+        if not servers:
+            TermMgr.print_prompt('No server is left to re-run tests')
+            return
+        server_tests = SchedMgr.distribute(tests, servers, self.distribute,
+                                           self.sched_history())
+        try:
+            env_mgr.deploy_tests(tests, server_tests)
+        except DeployError as e:
+            TermMgr.print_prompt('Can\'t deploy tests: {}'.format(e))
+            return
+
+        self.result_mgr.add_tests(tests)
+        for testcase in tests:
+            self.result_mgr.update(testcase.relpath, TestResult.NOTRUN)
+        SchedMgr.requeue(self.test_queue, tests, server_tests, self.distribute)
+
+    def watch_tests(self, env_mgr):
+        """Re-run tests whenever their scripts or dependencies change, until
+        user presses Ctrl-C. The daemon, ssh connections and agents are kept
+        alive in the meantime.
+        """
+
+        with WatchMgr(TestsetMgr._TEST_ROOT_) as watch_mgr:
+            try:
+                while True:
+                    TermMgr.print_prompt('Watching tests for changes, press '
+                                         'Ctrl-C to stop...')
+                    # Changed tests which were busy are checked periodically
+                    timeout = self._DEFER_CHECK_INTERVAL_ \
+                              if self.deferred else None
+                    changed = watch_mgr.wait_changes(timeout)
+                    self.rerun_tests(env_mgr, changed)
+            except KeyboardInterrupt:
+                logger.info('Stop watching tests')
+            finally:
+                self.watching = False
+
+    def peers_busy(self, server):
+        """Check if servers other than 'server' still have tests queued or
+        not reported done. Sharded tests of a server are moved to the servers
+        still waiting if its agent dies, so agents are kept until then.
+        """
+
+        if self.distribute != DISTRIBUTE_SHARD:
+            return False
+
+        busy = self.result_mgr.busy_servers()
+        return any(s != server and (s in busy or self.test_queue.pending(s))
+                   for s in self.result_mgr.running_servers())
+
+    def drop_server(self, env_mgr, server):
+        """Give up 'server' whose agent is dead: the tests it's running are
+        aborted, and the tests it hasn't started are moved to other servers
+        still running tests. Only sharded tests need to be moved, as other
+        servers run the same tests otherwise.
+        """
+
+        logger.error('Agent on %s is dead', server)
+
+        # Agents waiting for its tests are not let go in the meantime
+        with self.assign_lock:
+            self.result_mgr.kill_server(server)
+            tests = self.test_queue.take(server)
+            if self.distribute != DISTRIBUTE_SHARD or not tests:
+                return
+
+            running = self.result_mgr.running_servers()
+            servers = [s for s in self.servers
+                       if s in running and s not in self.released]
+            if not servers:
+                logger.error('No server is left to run %d tests of %s',
+                             len(tests), server)
+                return
+            self.reassigning += 1
+
+        try:
+            logger.info('Move %d tests of %s to %s', len(tests), server,
+                        servers)
+            server_tests = SchedMgr.distribute(tests, servers, self.distribute,
+                                               self.sched_history())
+            env_mgr.deploy_tests(tests, server_tests)
+            SchedMgr.requeue(self.test_queue, tests, server_tests,
+                             self.distribute)
+        except DeployError as e:
+            logger.error('Can\'t move tests of %s: %s', server, str(e))
+        finally:
+            with self.assign_lock:
+                self.reassigning -= 1
+
+    def monitor_agents(self, env_mgr):
+        """Drop servers whose agents miss too many heartbeats in a row, until
+        agents of all servers are finished.
+        """
+
+        interval = self.config_mgr.daemon_heartbeat_interval
+        timeout = interval * self.config_mgr.daemon_heartbeat_misses
+        self.result_mgr.reset_beats()
+        while not self.result_mgr.wait_done(timeout=interval):
+            for server in self.result_mgr.silent_servers(timeout):
+                self.drop_server(env_mgr, server)
+
     def stop_daemon(self, daemon_thread):
         self.daemon.stop()
         daemon_thread.join()
@@ -76,28 +414,48 @@ class TestMgr(object):
     def run(self):
         """ Start to run tests. """
 
+        if self.explain_selection:
+            self.explain()
+            return
+
         logger.info('Start to run tests') 
         
         # Make sure all requested server are accessible
-        config_mgr = ConfigMgr() 
         self.check_server_connectivity()
 
         # Initialize env manager
         env_mgr = EnvMgr(self.servers, self.config_mgr.server_username,
                          self.config_mgr.server_password,
-                         self.config_mgr.server_testdir)
+                         self.server_dir,
+                         self.config_mgr.server_concurrency, self.pool,
+                         self.deploy_mode, self.config_mgr.server_relay_fanout)
 
         # Collect tests per uer input
         TermMgr.print_prompt('Collecting test scripts...')
-        self.testcases = TestsetMgr.get_tests(self.tests, self.groups)
+        self.testcases = self.collect_tests()
         if not self.testcases:
             TermMgr.print_prompt('No tests need to be run')
             return
 
+        # Decide which tests are run by which server and in which order
+        tests = [t for t in self.testcases if t.result == TestResult.NOTRUN]
+        tests = SchedMgr.order(tests, self.schedule, self.history)
+        server_tests = SchedMgr.distribute(tests, self.servers, self.distribute,
+                                           self.sched_history())
+        active_servers = [s for s in self.servers
+                          if server_tests[s] or self.watch]
+        self.test_queue = SchedMgr.make_queue(tests, server_tests,
+                                              self.distribute)
+
         TermMgr.print_prompt('Tests are running...')
         relpaths = [c.relpath for c in self.testcases]
         with TermMgr(relpaths) as tm:
-            result_mgr = ResultMgr(self.testcases, tm, env_mgr)
+            result_mgr = ResultMgr(self.testcases, tm, env_mgr,
+                                   servers=active_servers,
+                                   history=self.history,
+                                   tail_lines=self.tail_lines,
+                                   follow=self.follow)
+            self.result_mgr = result_mgr
 
             # Show skipped tests on terminal 
             result_mgr.sync_skipped_tests()
@@ -106,35 +464,39 @@ class TestMgr(object):
             self.remote_agent_dir = env_mgr.deploy_agents()
 
             # Deploy test scripts to test servers
-            tests = [t.abspath for t in self.testcases if \
-                                     t.result == TestResult.NOTRUN]
-            remote_test_dir = env_mgr.deploy_tests(tests)
+            remote_test_dir = env_mgr.deploy_tests(tests, server_tests)
 
-            # Start daemon for syncing up status from test servers
-            daemon_thread = self.start_daemon(result_mgr.sync_result)
+            # Start daemon for handing out tests and syncing up status from
+            # test servers
+            daemon_thread = self.start_daemon(self.handle_msg,
+                                              self.receive_msg)
 
             # Start to run tests on all test servers
             logger.info('Begin to run tests ...')
+            self.launch_agents(active_servers, remote_test_dir,
+                               env_mgr.run_dir)
 
-            fmt = 'cd {}; nohup {} --testdir {} --sync --server {} &'
-            agent_script = path.join(self.remote_agent_dir, 'remoterun.py')
-            cmd = fmt.format(self.remote_agent_dir, agent_script,
-                             remote_test_dir, self.daemon_ip)
+            # Detect agents which stop sending heartbeats
+            monitor = threading.Thread(target=self.monitor_agents,
+                                       args=(env_mgr,))
+            monitor.setDaemon(True)
+            monitor.start()
 
-            for server in self.servers:
-                with SSHClient(
-                        server=server,
-                        username=self.config_mgr.server_username,
-                        password=self.config_mgr.server_password) as ssh:
-                    logger.debug('Run tests on {}, cmd:{}'.format(server, cmd))
-                    ssh.exec_command(cmd)
+            # Re-run changed tests until user stops watching
+            if self.watch:
+                self.watch_tests(env_mgr)
+                TermMgr.print_prompt('Tests are running...')
 
-            # Wait for all tests finish
-            while not result_mgr.tests_done:
-                time.sleep(2)
+            # Wait for agents of all servers to report their tests finished
+            result_mgr.wait_done()
 
-            # Stop easytest daemon and exit
+            # Stop easytest daemon and exit once support bundles of failed
+            # tests are downloaded
             self.stop_daemon(daemon_thread)
+            result_mgr.wait_downloads()
+            self.history.save()
+            self.pool.close()
 
             tm.summarize(result_mgr.info())
+            tm.print_tails(result_mgr.failed_tails())
         logger.info('All tests are finished: %s', result_mgr.info())
@@ -1,18 +1,38 @@
 #!/usr/bin/python3
 
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import logging
+import os
 from os import path
 import re
 import sys
 
 from .resultmgr import TestResult
 from .exceptions import MalformedScriptError
+from .groupmgr import GroupIndex, GroupMgr
+from .indexmgr import IndexMgr
 from .logger import get_logger
 
 
 TEST_GROUP_ENABLED = 'enabled' 
 TEST_GROUP_DISABLED = 'disabled' 
+HEADER_FIELDS = ('groups', 'disabled_groups', 'parallel', 'timeout', 'cpus',
+                 'mem', 'requires', 'inferred')
+MEM_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+# Declarations beyond the first HEADER_MAX_BYTES bytes of script are ignored
+HEADER_MAX_BYTES = 64 << 10
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+_SCAN_BATCH_ = 64
+_SNIFF_BYTES_ = 1024
+REGEX_GROUP = re.compile(r'#group-(.*)(\s*):(\s*)(.+)')
+REGEX_PARALLEL = re.compile(r'#parallel(\s*):(\s*)(.+)')
+REGEX_TIMEOUT = re.compile(r'#timeout(\s*):(\s*)(\d+(\.\d*)?)\s*$')
+REGEX_CPUS = re.compile(r'#cpus(\s*):(\s*)([1-9]\d*)\s*$')
+REGEX_REQUIRES = re.compile(r'#requires(\s*):(\s*)(.+)')
+REGEX_MEM = re.compile(r'#mem(\s*):(\s*)(\d+)\s*([KMGT]?)B?\s*$',
+                       re.IGNORECASE)
+REGEX_PATH_REFERENCE = re.compile(r'(?<![\w./-])(bin/[\w.+-]+(?:/[\w.+-]+)*)')
 logger = get_logger('TestsetMgr', level=logging.DEBUG)
 
 
@@ -25,6 +45,20 @@ class TestCase:
         self.groups = [] 
         self.disabled_groups = []
         self.parallel = False 
+        self.timeout = None
+        self.cpus = 1
+        self.mem = 0
+        # Files the test uses, relative to the directory of test script
+        self.requires = []
+        # Files referenced by plain paths in test script, which are inferred
+        # only for tests selected to run and then cached with their headers,
+        # None if they aren't inferred yet
+        self.inferred = None
+        # Files the test uses, relative to the tests directory, which are
+        # resolved once by TestsetMgr.get_dependencies()
+        self.dependencies = None
+        # Why the test is selected to run or skipped
+        self.reasons = []
         self.result = TestResult.NOTRUN 
 
         # Support bundle (contains log and potential coredump) of failed test
@@ -40,14 +74,50 @@ class TestCase:
     def set_parallel(self, parallel):
         self.parallel = parallel
 
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    def set_cpus(self, cpus):
+        self.cpus = cpus
+
+    def set_mem(self, mem):
+        self.mem = mem
+
+    def add_requires(self, requires):
+        self.requires.append(requires)
+
+    def add_reason(self, reason):
+        self.reasons.append(reason)
+
+    def fits(self, cpus, mem, idle):
+        """Check if the test can start on a server with 'cpus' and 'mem' bytes
+        free. A test which isn't parallel, or which demands more than the
+        server has, only starts on an idle server.
+        """
+
+        if idle:
+            return True
+        return self.parallel and self.cpus <= cpus and self.mem <= mem
+
     def set_result(self, result):
         self.result = result
 
+    def headers(self):
+        """Return the properties declared in test script as a dict"""
+
+        return {field: getattr(self, field) for field in HEADER_FIELDS}
+
+    def set_headers(self, headers):
+        for field in HEADER_FIELDS:
+            setattr(self, field, headers[field])
+
     def __str__(self):
         fmt = ('Testcase:\n\tabspath {}\n\trelpath {}\n\tgroups {}\n\t'
-               'disabled groups {}\n\tparalle {}\n\tresult {}')
+               'disabled groups {}\n\tparalle {}\n\ttimeout {}\n\tcpus {}\n\t'
+               'mem {}\n\trequires {}\n\tresult {}')
         return fmt.format(self.abspath, self.relpath, self.groups,
-                          self.disabled_groups, self.parallel, self.result)
+                          self.disabled_groups, self.parallel, self.timeout,
+                          self.cpus, self.mem, self.requires, self.result)
 
 
 class TestsetMgr(object):
@@ -61,44 +131,373 @@ class TestsetMgr(object):
 
 
     @staticmethod
-    def get_tests(req_tests, req_groups):
+    def in_test_root(localf, test_root=None):
+        """Check if path 'localf' is located under the tests directory"""
+
+        if test_root is None:
+            test_root = TestsetMgr._TEST_ROOT_
+        relpath = path.relpath(path.normpath(localf), path.normpath(test_root))
+        return relpath != '..' and not relpath.startswith('..' + os.sep)
+
+    @staticmethod
+    def requires_candidates(test_script, requires, test_root=None):
+        """Return paths which 'requires' of test script may refer to, that
+        is relative to the directory of script or to the tests directory.
+        Paths resolved outside the tests directory are left out.
+        """
+
+        if test_root is None:
+            test_root = TestsetMgr._TEST_ROOT_
+        if path.isabs(requires):
+            return []
+        candidates = [path.join(path.dirname(test_script), requires),
+                      path.join(test_root, requires)]
+        return [path.normpath(c) for c in candidates \
+                if TestsetMgr.in_test_root(c, test_root)]
+
+    @staticmethod
+    def infer_requires(testcase):
+        """Return files under the tests directory which are referenced by
+        plain paths like 'bin/xxx' in test script. Script is read line by
+        line, and binary files reference nothing.
+        """
+
+        references = set()
+        try:
+            with open(testcase.abspath, 'rb') as f:
+                if b'\0' in f.read(_SNIFF_BYTES_):
+                    return []
+
+                f.seek(0)
+                for line in f:
+                    line = line.decode('utf-8', 'ignore')
+                    references.update(path.normpath(m.group(1)) for m in \
+                                      REGEX_PATH_REFERENCE.finditer(line))
+        except OSError as e:
+            logger.warning('Can\'t read %s: %s', testcase.abspath, str(e))
+            return []
+
+        return sorted(references)
+
+    @staticmethod
+    def infer_testcases(testcases, index, workers=SCAN_WORKERS):
+        """Infer files referenced by 'testcases' whose references aren't
+        cached in 'index' yet, and cache them unless the script was modified
+        since its headers were parsed.
+        """
+
+        testcases = [t for t in testcases if t.inferred is None]
+        if not testcases:
+            return
+
+        logger.info('Infer files referenced by %d test scripts',
+                    len(testcases))
+        workers = max(1, min(workers, len(testcases) // _SCAN_BATCH_ + 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            stats = list(executor.map(lambda t: os.stat(t.abspath), testcases))
+            inferred = executor.map(TestsetMgr.infer_requires, testcases)
+            for testcase, stat, references in zip(testcases, stats, inferred):
+                testcase.inferred = references
+                if index.lookup(testcase.abspath, stat) is not None:
+                    index.update(testcase.abspath, stat, testcase.headers())
+
+    @staticmethod
+    def get_dependencies(testcase):
+        """Return files used by the test, which are declared by '#requires' or
+        inferred from path references in test script. Files are relative to
+        the tests directory, and directories are expanded to files under them.
+        They are resolved once per testcase, and referenced paths are taken
+        from the cached headers instead of reading the script again.
+        """
+
+        if testcase.dependencies is not None:
+            return testcase.dependencies
+
+        declared = set(testcase.requires)
+        dependencies = set()
+        for requires in declared | set(testcase.inferred or []):
+            candidates = TestsetMgr.requires_candidates(testcase.abspath,
+                                                        requires)
+            found = [c for c in candidates if path.exists(c)]
+            if not found:
+                if requires in declared:
+                    logger.warning('%s requires missing file %s',
+                                   testcase.relpath, requires)
+                continue
+
+            localf = found[0]
+            if path.isdir(localf):
+                search_path = path.join(localf, '**/*')
+                files = [f for f in glob.glob(search_path, recursive=True)
+                         if path.isfile(f)]
+            else:
+                files = [localf]
+            for f in files:
+                dependencies.add(path.relpath(f, TestsetMgr._TEST_ROOT_))
+
+        testcase.dependencies = sorted(dependencies)
+        return testcase.dependencies
+
+    @staticmethod
+    def change_reasons(testcase, changed):
+        """Return reasons why 'testcase' is affected by files in 'changed',
+        which are absolute paths. It's affected if its script or any of its
+        dependencies changed.
+        """
+
+        reasons = []
+        if path.realpath(testcase.abspath) in changed:
+            reasons.append('script changed')
+        for relpath in TestsetMgr.get_dependencies(testcase):
+            localf = TestsetMgr.get_test_fullpath(relpath)
+            if path.realpath(localf) in changed:
+                reasons.append('dependency {} changed'.format(relpath))
+        return reasons
+
+    @staticmethod
+    def get_tests(req_tests, req_groups, index=None, changed=None):
         """ Search under directory 'test_root' and return all test scripts
-        belonging to groups 'req_groups'
+        matching any of group expressions 'req_groups', such as 'C13' or
+        '(net or storage) and not slow'. Tests which would match if their
+        disabled groups were enabled are returned as skipped. If 'changed' is
+        given, only tests affected by the changed files in it are returned.
+        Parsed test scripts are cached in 'index', which defaults to the index
+        saved in history directory.
         """
 
         logger.info('Collect test scripts...')
+        save_index = index is None
+        if index is None:
+            index = IndexMgr()
+
         tests = []
         if req_tests:
             # Get tests from script(s) explicitly specified by user
-            for test in req_tests:
-                 test_script = TestsetMgr.get_test_fullpath(test)
-                 testcase = TestsetMgr.get_testcase(test_script)
-                 if set(req_groups).issubset(set(testcase.groups)):
+            test_scripts = [TestsetMgr.get_test_fullpath(t) for t in req_tests]
+            for testcase in TestsetMgr.load_testcases(test_scripts, index):
+                 if set(req_groups or []).issubset(set(testcase.groups)):
+                     testcase.add_reason('requested by --test')
                      tests.append(testcase)
         else:
-            # Get tests from group(s) explicitly specified by user
+            # Get tests from group expression(s) specified by user, or all
+            # tests if only changed tests are requested
             test_path_wildcard = path.join(TestsetMgr._TEST_ROOT_, '**/*.*')
-            for test_script in glob.glob(test_path_wildcard, recursive=True):
-                testcase = TestsetMgr.get_testcase(path.normpath(test_script))
-                for group in set(req_groups):
-                    if group in testcase.groups:
-                        tests.append(testcase)
-                        break
-
-                if testcase not in tests:
-                    for group in set(req_groups):
-                        if group in testcase.disabled_groups:
-                            testcase.set_result(TestResult.SKIPPED)
-                            tests.append(testcase)
-                            break
-
+            test_scripts = [path.normpath(f) for f in \
+                            glob.glob(test_path_wildcard, recursive=True)]
+            group_index = GroupIndex(TestsetMgr.load_testcases(test_scripts,
+                                                               index))
+            if req_groups:
+                expr = GroupMgr.parse(req_groups)
+                selected, skipped = group_index.select(expr)
+                reason = 'matches group {}'.format(', '.join(req_groups))
+            else:
+                selected, skipped = group_index.universe, 0
+                reason = 'no group filter'
+
+            for testcase in group_index.testcases_of(selected):
+                testcase.add_reason(reason)
+            for testcase in group_index.testcases_of(skipped):
+                groups = sorted(set(testcase.disabled_groups) & expr.groups())
+                testcase.add_reason('skipped, disabled in group {}'.format(
+                    ', '.join(groups)))
+                testcase.set_result(TestResult.SKIPPED)
+            tests = group_index.testcases_of(selected | skipped)
+            index.prune(test_scripts)
+
+        # Only scripts of tests selected are read in full
+        TestsetMgr.infer_testcases(tests, index)
+
+        if changed is not None:
+            affected = []
+            for testcase in tests:
+                reasons = TestsetMgr.change_reasons(testcase, changed)
+                if reasons:
+                    for reason in reasons:
+                        testcase.add_reason(reason)
+                    affected.append(testcase)
+            logger.info('%d of %d tests are affected by changed files',
+                        len(affected), len(tests))
+            tests = affected
+
+        if save_index:
+            index.save()
         logger.info('Found tests: %s', str([test.relpath for test in tests]))
         return tests
 
     @staticmethod
-    def get_testcase(test_script):
+    def explain(tests):
+        """Return printable lines explaining why each test is selected"""
+
+        lines = []
+        for testcase in tests:
+            lines.append('{} [{}]'.format(testcase.relpath,
+                                          testcase.result.value))
+            lines.extend('    ' + reason for reason in testcase.reasons)
+        return lines
+
+    @staticmethod
+    def load_testcases(test_scripts, index, workers=SCAN_WORKERS):
+        """Return testcases of 'test_scripts', whose headers are taken from
+        'index' unless the script was added or modified since last parsed.
+        Scripts to be parsed are scanned by a pool of 'workers' threads, and
+        malformed headers of all scripts are reported by one exception.
+        """
+
+        testcases = {}
+        stats = {}
+        for test_script in test_scripts:
+            stat = os.stat(test_script)
+            headers = index.lookup(test_script, stat)
+            if headers is None:
+                stats[test_script] = stat
+                continue
+
+            relpath = path.relpath(test_script, TestsetMgr._TEST_ROOT_)
+            testcase = TestCase(test_script, relpath)
+            testcase.set_headers(headers)
+            testcases[test_script] = testcase
+
+        if stats:
+            logger.info('Scan %d new or modified test scripts', len(stats))
+        workers = max(1, min(workers, len(stats) // _SCAN_BATCH_ + 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scanned = executor.map(TestsetMgr.scan_testcase, stats)
+            errors = []
+            for test_script, (testcase, script_errors) in zip(stats, scanned):
+                if script_errors:
+                    errors.extend(script_errors)
+                    continue
+                index.update(test_script, stats[test_script],
+                             testcase.headers())
+                testcases[test_script] = testcase
+
+        if errors:
+            raise MalformedScriptError('\n'.join(errors))
+        return [testcases[test_script] for test_script in test_scripts]
+
+    @staticmethod
+    def read_header(test_script):
+        """Return lines of the leading comment block of test script, where
+        test properties are declared. The block ends at the first line which
+        is neither blank nor a comment. Binary files have no header.
+        """
+
+        lines = []
+        with open(test_script, 'rb') as f:
+            if b'\0' in f.read(_SNIFF_BYTES_):
+                return lines
+
+            f.seek(0)
+            size = 0
+            for line in f:
+                size += len(line)
+                if size > HEADER_MAX_BYTES:
+                    break
+
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if line.strip() and not line.startswith('#'):
+                    break
+                lines.append(line)
+        return lines
+
+    @staticmethod
+    def scan_testcase(test_script, test_root=None):
+        """Parse header of test script, return the testcase and a list of
+        errors found in malformed declarations.
+        """
+
+        logger.debug('Check script %s', test_script)
+
+        if test_root is None:
+            test_root = TestsetMgr._TEST_ROOT_
+        relpath = path.relpath(test_script, test_root)
+        testcase= TestCase(test_script, relpath)
+        errors = []
+        set_parallel = False
+        set_timeout = False
+        for line in TestsetMgr.read_header(test_script):
+            malformed = False
+
+            # Parse groups
+            if line.startswith('#group-'):
+                m = REGEX_GROUP.match(line)
+                if m:
+                    group = m.group(1).strip()
+                    state = m.group(4).strip()
+                    if state == TEST_GROUP_ENABLED:
+                        testcase.add_group(group)
+                    elif state == TEST_GROUP_DISABLED:
+                        testcase.add_disabled_group(group)
+                else:
+                    malformed = True
+
+            # Parse parallelism, we should do this at most once
+            elif line.startswith('#parallel'):
+                if set_parallel:
+                    msgFmt = 'More than one "#parallel: xxx" exist in {}'
+                    errors.append(msgFmt.format(test_script))
+
+                set_parallel = True
+                m = REGEX_PARALLEL.match(line)
+                if m:
+                    parallel_run = (m.group(3).strip().lower() == 'true')
+                    testcase.set_parallel(parallel_run)
+
+            # Parse timeout, we should do this at most once
+            elif line.startswith('#timeout'):
+                if set_timeout:
+                    msgFmt = 'More than one "#timeout: xxx" exist in {}'
+                    errors.append(msgFmt.format(test_script))
+
+                set_timeout = True
+                m = REGEX_TIMEOUT.match(line)
+                if m:
+                    testcase.set_timeout(float(m.group(3)))
+                else:
+                    malformed = True
+
+            # Parse resources needed by the test
+            elif line.startswith('#cpus'):
+                m = REGEX_CPUS.match(line)
+                if m:
+                    testcase.set_cpus(int(m.group(3)))
+                else:
+                    malformed = True
+
+            elif line.startswith('#requires'):
+                m = REGEX_REQUIRES.match(line)
+                if m:
+                    for requires in m.group(3).replace(',', ' ').split():
+                        requires = path.normpath(requires)
+                        if not TestsetMgr.requires_candidates(
+                                test_script, requires, test_root):
+                            msgFmt = 'Error: "{}" is outside tests ' \
+                                     'directory in {}'
+                            errors.append(msgFmt.format(requires, test_script))
+                            continue
+                        testcase.add_requires(requires)
+                else:
+                    malformed = True
+
+            elif line.startswith('#mem'):
+                m = REGEX_MEM.match(line)
+                if m:
+                    unit = MEM_UNITS[m.group(4).upper()]
+                    testcase.set_mem(int(m.group(3)) * unit)
+                else:
+                    malformed = True
+
+            if malformed:
+                errors.append('Error: "{}" in {}'.format(line, test_script))
+
+        logger.debug(str(testcase))
+        return testcase, errors
+
+    @staticmethod
+    def get_testcase(test_script, test_root=None):
         """Parse test script and get group list to which the test belongs and
-        parallelism state.
+        parallelism state. The relative path of the test is computed against
+        'test_root', which defaults to the local tests directory.
 
         Note: 1) a test can belong to one or multiple groups by below
                  declarations:
@@ -111,46 +510,29 @@ class TestsetMgr(object):
 
               2) A test can declare to be parallel or not by below statement:
                        #parallel : true  #or false
-        """
 
-        logger.debug('Check script %s', test_script)
+              3) A test can declare how many seconds it may run before being
+                 aborted by below statement:
+                       #timeout : 600
 
-        # Set patterns for parsing group and parallel properties
-        regex_group = re.compile('#group-(.*)(\s*):(\s*)(.+)')
-        regex_parallel = re.compile('#parallel(\s*):(\s*)(.+)')
+              4) A test can declare the cpus and memory it needs when running
+                 in parallel with other tests by below statements, a test
+                 declaring nothing needs one cpu:
+                       #cpus : 8
+                       #mem : 4G
 
-        # Check test script line by line
-        relpath = path.relpath(test_script, TestsetMgr._TEST_ROOT_)
-        testcase= TestCase(test_script, relpath)
-        with open(test_script) as f:
-            set_parallel = False
-            for line in f:
-                # Parse groups
-                if line.startswith('#group-'):
-                    m = regex_group.match(line)
-                    if m:
-                        group = m.group(1).strip()
-                        state = m.group(4).strip()
-                        if state == TEST_GROUP_ENABLED:
-                            testcase.add_group(group)
-                        elif state == TEST_GROUP_DISABLED:
-                            testcase.add_disabled_group(group)
-                    else:
-                        msg = 'Error: "{}" in {}'.format(line, test_script)
-                        raise MalformedScriptError(msg)
-
-                # Parse parallelism, we should do this at most once
-                elif line.startswith('#parallel'):
-                    if set_parallel:
-                        msgFmt = 'More than one "#parallel: xxx" exist in {}'
-                        raise MalformedScriptError(msgFmt.format(test_script))
-
-                    set_parallel = True
-                    m = regex_parallel.match(line)
-                    if m:
-                        parallel_run = (m.group(3).strip().tolower() == 'true')
-                        testcase.set_parallel(parallel_run)
-        logger.debug(str(testcase))
+              5) A test can declare the files or directories it uses, relative
+                 to its own directory, by one or more below statements:
+                       #requires : bin/divideby0
+
+              6) All declarations must be in the leading comment block of test
+                 script, which ends at the first line that is neither blank nor
+                 a comment.
+        """
+
+        testcase, errors = TestsetMgr.scan_testcase(test_script, test_root)
+        if errors:
+            raise MalformedScriptError('\n'.join(errors))
         return testcase
 
 
@@ -163,5 +545,9 @@ if __name__ == "__main__":
     logger.info('Test: %s', testcase.abspath)
     logger.info('relpath: %s', testcase.relpath)
     logger.info('Parallel: %s', testcase.parallel)
+    logger.info('Timeout: %s', testcase.timeout)
+    logger.info('Cpus: %s', testcase.cpus)
+    logger.info('Mem: %s', testcase.mem)
+    logger.info('Requires: %s', testcase.requires)
     logger.info('Groups: %s', testcase.groups)
     logger.info('Result: %s', testcase.result)
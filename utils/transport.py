@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+
+"""Transports between easytest daemon and agents. The daemon serves messages
+of agents over channels of a transport, and agents talk to it by a connector
+of the same transport: 'ssh' works across servers, 'local' runs agents on the
+controller host itself and passes messages over a unix socket.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import selectors
+import socket
+import threading
+
+from .exceptions import ProtocolError, SessionBrokenError
+from .message import ErrorMsg, FrameDecoder, Message
+from .logger import get_logger
+
+
+TRANSPORT_SSH = 'ssh'
+TRANSPORT_LOCAL = 'local'
+TRANSPORT_MODES = (TRANSPORT_SSH, TRANSPORT_LOCAL)
+
+
+class MsgConnector(object):
+    """Connection of easytest agent to daemon, subclasses open 'chan' which
+    supports sendall() and recv() like a socket.
+    """
+
+    _RECV_SIZE_ = 1 << 16
+
+    def __init__(self):
+        self.chan = None
+        self.decoder = FrameDecoder()
+        # Payloads received but not returned by recv() yet
+        self.payloads = deque()
+        self.logger = get_logger(type(self).__name__, level=logging.DEBUG)
+
+    def connect(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def send(self, msg):
+        if self.chan:
+            self.chan.sendall(msg)
+
+    def recv(self):
+        """Return payload of the next message from server"""
+
+        if not self.chan:
+            return None
+
+        while not self.payloads:
+            data = self.chan.recv(MsgConnector._RECV_SIZE_)
+            if not data:
+                raise SessionBrokenError('Connection is closed by server')
+            self.payloads.extend(self.decoder.feed(data))
+
+        payload = self.payloads.popleft()
+        if Message.get_type(payload) == 'error':
+            raise ProtocolError(Message.parse_msg(payload)['error'])
+        return payload
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MsgServer(object):
+    """easytest daemon, which serves messages from easytest agents. Channels
+    are watched by a selector, and messages are dispatched to a pool of
+    handler threads. Messages from one channel are handled one after another
+    in the order they arrive, while messages of different channels are handled
+    concurrently. Subclasses decide how connections are listened to and how
+    channels are opened on them.
+
+    Messages are also passed to 'recv_handler', if given, as soon as they are
+    received. It returns True if it handled the message, which isn't queued
+    then, so that messages like heartbeats don't wait for earlier ones.
+    """
+
+    _RECV_SIZE_ = 1 << 16
+    _HANDLER_WORKERS_ = 32
+    _SELECT_TIMEOUT_ = 1
+
+    def __init__(self, msg_handler, recv_handler=None):
+        self.msg_handler = msg_handler
+        self.recv_handler = recv_handler
+        self.sock_thread = None
+        # Set once server is listening or failed to listen
+        self.ready = threading.Event()
+        self.error = None
+        self.chan_thread = None
+        self.chans = set()
+        self.chan_lock = threading.Lock()
+        self._exit = False
+        self.logger = get_logger(type(self).__name__, level=logging.DEBUG)
+
+        # Channels accepted but not watched by selector yet
+        self.new_chans = []
+        # Messages received but not handled yet, keyed by channel
+        self.pending_msgs = {}
+        # Decoders splitting the byte stream of channel into messages
+        self.decoders = {}
+        # Channels whose messages are being handled
+        self.busy_chans = set()
+        self.selector = None
+        self.executor = None
+        self.wakeup_fds = os.pipe()
+
+    def address(self):
+        """Return the address listened on, which is shown in logs"""
+
+        raise NotImplementedError
+
+    def listen(self):
+        """Return the socket bound to the address listened on"""
+
+        raise NotImplementedError
+
+    def accept_chan(self, connsock, addr):
+        """Open channel on accepted connection, and add it by add_chan()"""
+
+        raise NotImplementedError
+
+    def recv_chan(self, chan):
+        """Return data read from channel which is ready, b'' if the channel is
+        closed, or None if there is nothing to read yet.
+        """
+
+        raise NotImplementedError
+
+    def shutdown_chan(self, chan):
+        """Close channel and the connection it's opened on"""
+
+        raise NotImplementedError
+
+    def peer_name(self, chan):
+        """Return the address of agent on channel, which is shown in logs"""
+
+        try:
+            return str(chan.getpeername())
+        except OSError:
+            return str(chan)
+
+    def wait_ready(self, timeout=None):
+        """Block until server is listening, raise exception if it failed"""
+
+        if not self.ready.wait(timeout):
+            raise SessionBrokenError('Server isn\'t up in {} seconds'.format(
+                timeout))
+        if self.error is not None:
+            msg = 'Server can\'t listen on {}: {}'.format(self.address(),
+                                                           self.error)
+            raise SessionBrokenError(msg)
+
+    def execute(self):
+        self.sock_thread = threading.Thread(target=self.handle_connect_req)
+        self.sock_thread.setDaemon(True)
+        self.sock_thread.start()
+
+        self.chan_thread = threading.Thread(target=self.process_msg)
+        self.chan_thread.setDaemon(True)
+        self.chan_thread.start()
+
+        self.sock_thread.join()
+        self.chan_thread.join()
+        self.logger.info('Server is stopped')
+
+    def wakeup(self):
+        """Wake up selector, so that it watches new channels or exits"""
+
+        os.write(self.wakeup_fds[1], b'\0')
+
+    def stop(self):
+        self._exit = True
+        self.wakeup()
+
+    def response_msg(self, chan, msg):
+        if chan:
+            chan.sendall(msg)
+
+    def add_chan(self, chan):
+        """Watch messages of channel accepted"""
+
+        with self.chan_lock:
+            self.chans.add(chan)
+            self.new_chans.append(chan)
+        self.wakeup()
+
+    def watch_new_chans(self):
+        with self.chan_lock:
+            new_chans, self.new_chans = self.new_chans, []
+        for chan in new_chans:
+            self.selector.register(chan, selectors.EVENT_READ)
+
+    def close_chan(self, chan):
+        self.selector.unregister(chan)
+        with self.chan_lock:
+            self.pending_msgs.pop(chan, None)
+            self.decoders.pop(chan, None)
+            self.chans.discard(chan)
+        self.shutdown_chan(chan)
+
+    def read_chan(self, chan):
+        """Read from channel which is ready, and dispatch messages completely
+        received. A channel sending anything but messages of current protocol
+        version is dropped.
+        """
+
+        data = self.recv_chan(chan)
+        if data is None:
+            return
+        if not data:
+            self.logger.debug('Channel of %s is closed', self.peer_name(chan))
+            self.close_chan(chan)
+            return
+
+        decoder = self.decoders.setdefault(chan, FrameDecoder())
+        try:
+            msgs = decoder.feed(data)
+        except ProtocolError as e:
+            self.logger.error('Drop agent %s: %s', self.peer_name(chan),
+                              str(e))
+            try:
+                chan.sendall(ErrorMsg(str(e)).val)
+            except Exception:
+                pass
+            self.close_chan(chan)
+            return
+
+        for msg in msgs:
+            self.dispatch(chan, msg)
+
+    def dispatch(self, chan, msg):
+        """Queue message of channel, a handler is started for the channel
+        unless one is already handling its earlier messages.
+        """
+
+        if self.recv_handler is not None:
+            try:
+                if self.recv_handler(self, chan, msg):
+                    return
+            except Exception as e:
+                self.logger.error('Failed to handle message %s: %s', msg,
+                                  str(e))
+
+        with self.chan_lock:
+            self.pending_msgs.setdefault(chan, deque()).append(msg)
+            if chan in self.busy_chans:
+                return
+            self.busy_chans.add(chan)
+        self.executor.submit(self.handle_msgs, chan)
+
+    def handle_msgs(self, chan):
+        """Handle queued messages of channel in the order they arrived"""
+
+        while True:
+            with self.chan_lock:
+                msgs = self.pending_msgs.get(chan)
+                if not msgs:
+                    self.busy_chans.discard(chan)
+                    return
+                msg = msgs.popleft()
+
+            try:
+                self.msg_handler(self, chan, msg)
+            except Exception as e:
+                self.logger.error('Failed to handle message %s: %s', msg,
+                                  str(e))
+
+    def process_msg(self):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeup_fds[0], selectors.EVENT_READ)
+        with ThreadPoolExecutor(max_workers=self._HANDLER_WORKERS_) as executor:
+            self.executor = executor
+            while not self._exit:
+                self.watch_new_chans()
+                for key, _ in self.selector.select(self._SELECT_TIMEOUT_):
+                    if key.fileobj == self.wakeup_fds[0]:
+                        os.read(self.wakeup_fds[0], 4096)
+                    else:
+                        self.read_chan(key.fileobj)
+
+        # Close all active channels
+        self.selector.close()
+        for fd in self.wakeup_fds:
+            os.close(fd)
+        with self.chan_lock:
+            chans, self.chans = self.chans, set()
+        for chan in chans:
+            self.shutdown_chan(chan)
+
+    def handle_connect_req(self):
+        try:
+            listensock = self.listen()
+        except OSError as e:
+            self.error = e
+            self._exit = True
+            self.wakeup()
+            return
+        else:
+            self.logger.info('Server is listening on %s', self.address())
+        finally:
+            self.ready.set()
+
+        listensock.settimeout(1)
+        while True:
+            try:
+                connsock, addr = listensock.accept()
+            except socket.timeout:
+                if self._exit:
+                    break
+                else:
+                    continue
+            except Exception as e:
+                break
+
+            t = threading.Thread(target=self.accept_chan, args=(connsock, addr))
+            t.setDaemon(True)
+            t.start()
+
+        listensock.close()
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import ctypes
+import ctypes.util
+import logging
+import os
+from os import path
+import select
+import struct
+import time
+
+from .logger import get_logger
+
+
+# Events of inotify(7) which mean a file was written, created or removed
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+                | IN_CREATE | IN_DELETE
+_EVENT_HEADER_ = struct.Struct('iIII')
+logger = get_logger('WatchMgr', level=logging.DEBUG)
+
+
+class InotifyWatcher(object):
+    """Watch a directory tree by inotify(7) of linux"""
+
+    def __init__(self, root):
+        self.root = root
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        # Watched directories keyed by watch descriptor
+        self.dirs = {}
+        self.watch_tree(root)
+
+    def watch_tree(self, top):
+        """Watch 'top' and all directories under it, return files under them"""
+
+        files = set()
+        for dirpath, dirnames, filenames in os.walk(top):
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), IN_WATCH_MASK)
+            if wd < 0:
+                logger.warning('Can\'t watch %s: %s', dirpath,
+                               os.strerror(ctypes.get_errno()))
+                continue
+            self.dirs[wd] = dirpath
+            files.update(path.join(dirpath, f) for f in filenames)
+        return files
+
+    def read_changes(self, timeout):
+        """Return files changed within 'timeout' seconds, or None if events
+        were lost and the whole tree should be treated as changed.
+        """
+
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER_.unpack_from(data, offset)
+            offset += _EVENT_HEADER_.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd not in self.dirs or not name:
+                continue
+
+            filename = path.join(self.dirs[wd], os.fsdecode(name))
+            changed.add(filename)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may be created before the new directory is watched
+                changed.update(self.watch_tree(filename))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Watch a directory tree by comparing mtime and size of files, which is
+    used where inotify isn't available.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for f in filenames:
+                filename = path.join(dirpath, f)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                snapshot[filename] = (st.st_mtime_ns, st.st_size, st.st_mode)
+        return snapshot
+
+    def read_changes(self, timeout):
+        time.sleep(timeout)
+        snapshot = self.take_snapshot()
+        changed = set(f for f in set(snapshot) | set(self.snapshot)
+                      if snapshot.get(f) != self.snapshot.get(f))
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class WatchMgr(object):
+    """The util class for watching changes of files under a directory tree, by
+    inotify if possible, otherwise by polling.
+    """
+
+    # Changes are reported once files stay unchanged for this many seconds
+    _SETTLE_TIME_ = 0.3
+    _POLL_INTERVAL_ = 1
+
+    def __init__(self, root):
+        self.root = path.realpath(root)
+        try:
+            self.watcher = InotifyWatcher(self.root)
+            self.interval = self._SETTLE_TIME_
+        except (OSError, AttributeError, TypeError) as e:
+            logger.warning('Poll %s for changes, inotify is unavailable: %s',
+                           self.root, str(e))
+            self.watcher = PollingWatcher(self.root)
+            self.interval = self._POLL_INTERVAL_
+
+    def all_files(self):
+        return set(path.join(dirpath, f)
+                   for dirpath, _, filenames in os.walk(self.root)
+                   for f in filenames)
+
+    def wait_changes(self, timeout=None):
+        """Block until files under the tree change, and return them once no
+        more changes come in for a while. Return an empty set if nothing
+        changed in 'timeout' seconds.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while True:
+            changes = self.watcher.read_changes(self.interval)
+            if changes is None:
+                logger.warning('Lost track of changes, rescan %s', self.root)
+                changes = self.all_files()
+
+            if changes:
+                changed.update(changes)
+            elif changed:
+                break
+            elif deadline is not None and time.time() >= deadline:
+                break
+
+        logger.debug('Changed files: %s', sorted(changed))
+        return changed
+
+    def close(self):
+        self.watcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()